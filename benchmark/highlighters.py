@@ -0,0 +1,49 @@
+#! /usr/bin/python
+# Compare the syntax highlighting backends on the code blocks of one or
+# more Markdown files, e.g.
+#   python benchmark/highlighters.py template.md test.md --repeat 20
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import prism
+
+FENCE = re.compile(r'^```(\S+)\n(.*?)^```', re.S | re.M)
+
+def code_blocks(paths):
+    blocks = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for lang, code in FENCE.findall(f.read()):
+                # Request/response blocks are highlighted as HTTP
+                if lang == 'reqres': lang = 'http'
+                blocks.append((code, lang))
+    return blocks
+
+arg_parser = argparse.ArgumentParser(description='Benchmark the syntax highlighting backends')
+arg_parser.add_argument('files', nargs='+', help='Markdown files to take code blocks from')
+arg_parser.add_argument('--repeat', type=int, default=10, help='Number of passes over the code blocks')
+args = arg_parser.parse_args()
+
+blocks = code_blocks(args.files)
+print('%d code blocks, %d passes' % (len(blocks), args.repeat))
+print('%-10s %12s %12s %12s' % ('backend', 'startup ms', 'total ms', 'per block ms'))
+for name in prism.HIGHLIGHTERS:
+    start = time.perf_counter()
+    h = prism.get_highlighter(name)
+    # The first block pays for starting the backend
+    h.highlight(*blocks[0])
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for block in blocks:
+            prism.inline_style(h.highlight(*block))
+    total = time.perf_counter() - start
+    print('%-10s %12.1f %12.1f %12.3f' % (name, startup * 1000, total * 1000,
+        total * 1000 / (args.repeat * len(blocks))))
+prism.close()
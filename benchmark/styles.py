@@ -0,0 +1,68 @@
+#! /usr/bin/python
+# Time md2docx on synthetic code-heavy reports of growing size and nesting
+# depth, e.g.
+#   python benchmark/styles.py --renderer html --blocks 50 --depth 0 8
+# The cost per run should stay flat as the report grows and as code
+# blocks are nested deeper.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+MD2DOCX = os.path.join(os.path.dirname(__file__), '..', 'md2docx.py')
+
+CODE = '''def handler(request, *args, **kwargs):
+    """Look up the user and render their profile"""
+    user = User.objects.get(id=int(request.GET["id"]), active=True)
+    if user is None or not user.is_visible(request.user):
+        raise Http404("No such user: %s" % request.GET["id"])
+    return render(request, "profile.html", {"user": user, "count": 42})
+'''
+
+def report(blocks, depth):
+    # Code blocks nested `depth` block quotes deep, with a sentence between
+    quote = '> ' * depth
+    lines = ['# Code-heavy report', '']
+    for i in range(blocks):
+        lines.append('Finding %d has **bold**, *italic* and `inline` text.' % i)
+        lines.extend(['', '```python'] + CODE.splitlines() + ['```', ''])
+    return ''.join((quote + line).rstrip() + '\n' for line in lines)
+
+def run(path, output, args):
+    command = [sys.executable, MD2DOCX, output, '--files', path,
+        '--renderer', args.renderer, '--highlighter', args.highlighter,
+        '--cache-dir', os.path.join(os.path.dirname(path), 'cache')]
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+arg_parser = argparse.ArgumentParser(description='Benchmark styling and rendering of code-heavy reports')
+arg_parser.add_argument('--renderer', default='html', choices=['markdown', 'html'])
+arg_parser.add_argument('--highlighter', default='pygments')
+arg_parser.add_argument('--blocks', type=int, default=50, help='Code blocks in the smallest report')
+arg_parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4], help='Report sizes, as multiples of --blocks')
+arg_parser.add_argument('--depth', type=int, nargs='+', default=[0, 8], help='Block quote nesting depths')
+args = arg_parser.parse_args()
+
+print('%-6s %-6s %8s %10s %12s' % ('depth', 'blocks', 'runs', 'total ms', 'per run us'))
+with tempfile.TemporaryDirectory() as tmp:
+    for depth in args.depth:
+        for scale in args.scales:
+            blocks = args.blocks * scale
+            path = os.path.join(tmp, 'report.md')
+            output = os.path.join(tmp, 'report.docx')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(report(blocks, depth))
+            # The first run fills the highlight cache, so the timed run
+            # measures styling and rendering rather than highlighting
+            run(path, output, args)
+            total = run(path, output, args)
+            with zipfile.ZipFile(output) as z:
+                runs = len(re.findall(rb'<w:r>', z.read('word/document.xml')))
+            print('%-6d %-6d %8d %10.1f %12.1f' % (depth, blocks, runs, total * 1000,
+                total * 1e6 / max(runs, 1)))
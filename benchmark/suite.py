@@ -0,0 +1,211 @@
+#! /usr/bin/python
+# Benchmark md2docx on synthetic reports built from the constructs of
+# template.md, and catch regressions against stored baselines, e.g.
+#   python benchmark/suite.py --save    # record benchmark/baseline.json
+#   python benchmark/suite.py           # compare, exit status 1 on a regression
+# Baselines only compare on the machine they were recorded on, so record
+# them where the suite runs (e.g. on the CI runner, from the main branch).
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from PIL import Image
+
+MD2DOCX = os.path.join(os.path.dirname(__file__), '..', 'md2docx.py')
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Rough amount of text on a page of a report, to estimate page counts
+PAGE_CHARS = 3000
+
+CODE = [
+    ('javascript', '''function fibonacci(num) {
+  var a = 1, b = 0, temp;
+  while (num >= 0) {
+    temp = a;
+    a = a + b;
+    b = temp;
+    num--;
+  }
+  return b;
+}'''),
+    ('python', '''def handler(request, *args, **kwargs):
+    """Look up the user and render their profile"""
+    user = User.objects.get(id=int(request.GET["id"]), active=True)
+    if user is None or not user.is_visible(request.user):
+        raise Http404("No such user: %s" % request.GET["id"])
+    return render(request, "profile.html", {"user": user, "count": 42})'''),
+    ('bash', '''user@hostname:/home/user/docs/secrets$ ls -lah
+drwxr-xr-x user user 4.0 KB Fri Apr 16 15:35:15 2021 .
+drwx------ user user  20 KB Wed Apr 28 16:10:35 2021 ..
+.rw-r--r-- user user 1.1 KB Mon Jan 25 09:51:56 2021 secrets.json'''),
+    ('sql', '''SELECT u.id, u.name, o.total FROM users u
+JOIN orders o ON o.user_id = u.id
+WHERE u.email = '' OR 1=1 -- '
+ORDER BY o.total DESC LIMIT 10;'''),
+    ('json', '''{"kennitala": "1234561111", "dateOfBirth": "1956-12-34T00:00:00.000Z",
+ "nafn": "syndis", "netfang": "syndis@syndis.is", "roles": ["admin", "user"]}'''),
+]
+
+REQRES = '''--- Request
+POST /api/foo/%d HTTP/1.1
+Host: syndis.is
+Content-Type: application/json
+Cookie: session=3f2a9c0e8b7d6a5f4e3d2c1b0a998877
+
+{"kennitala":"1234561111","dateOfBirth":"1956-12-34T00:00:00.000Z","nafn":"syndis"}
+--- Response
+HTTP/1.1 200 OK
+Content-Type: text/html; charset=utf-8
+[...]
+
+<html><body><script>alert(document.domain)</script></body></html>'''
+
+IMAGES = 4
+
+def finding(i, appendix_rows):
+    language, code = CODE[i % len(CODE)]
+    lines = [
+        '## %d Reflected cross-site scripting in endpoint %d' % (i + 1, i + 1), '',
+        '| | |', '| ----------------- | ------- |',
+        '| **Severity**          | **%s** |' % ['Critical', 'High', 'Medium', 'Low', 'Informational'][i % 5],
+        '| **Date Sent**         | 2023-07-04 |',
+        '| **Location**          | `src/code/index%d.php#1337` |' % i,
+        '| **Issue Identifier**  | `SYN-XX-%d-Z` |' % i,
+        '| **Impact**            | Comments sent by X to Y are not sanitized, leading to a cross-site scripting vulnerability when a user views an order in Y. |',
+        '', '### Technical Details', '',
+        'The `comment` parameter of **/api/foo/%d** is reflected *without encoding*, see the '
+        '[OWASP cheat sheet](https://cheatsheetseries.owasp.org) for background. '
+        'An attacker can craft a link that runs script in the victim\'s session.' % i, '',
+        '- The input reaches the response unchanged',
+        '- The session cookie is not `HttpOnly`',
+        '  - so script can read it',
+        '- No Content Security Policy is set', '',
+        '```%s' % language, code, '```',
+        '**Figure %d.1:** *Code figure.*' % i, '',
+        '```reqres', REQRES % i, '```',
+        '**Figure %d.2:** *Reproduction request/response.*' % i, '',
+        '![screenshot](image%d.jpeg)' % (i % IMAGES),
+        '**Figure %d.3:** *Image figure.*' % i, '',
+        '| **Column 1** | **Column 2** | **Column 3** |',
+        '| ------------ | ------------ | ------------ |',
+        '| One          | Two          | Three        |',
+        '| Four         | Five         | Six          |',
+        '**Figure %d.4:** *Fancy table.*' % i, '',
+    ]
+    if appendix_rows:
+        lines.extend(['### Scan results', '',
+            '| **Host** | **Port** | **Service** | **Finding** |',
+            '| -------- | -------- | ----------- | ----------- |'])
+        for r in range(appendix_rows):
+            lines.append('| 10.0.%d.%d | %d | http | `X-Powered-By` header discloses PHP/7.%d |'
+                % (r // 250, r % 250, 8000 + r, r % 10))
+        lines.append('')
+    lines.extend(['### Recommendation', '',
+        '1. Encode output for the HTML context',
+        '2. Set `HttpOnly` on the session cookie',
+        '3. Add a Content Security Policy', ''])
+    return '\n'.join(lines)
+
+def write_report(directory, findings, appendix_every, appendix_rows):
+    os.makedirs(os.path.join(directory, 'findings'))
+    for i in range(IMAGES):
+        # Photo-sized images, so they get downscaled and recompressed
+        image = Image.radial_gradient('L').resize((2400, 1800)).convert('RGB')
+        image.paste((40 * i, 90, 160), (100 * i, 100, 100 * i + 400, 500))
+        image.save(os.path.join(directory, 'image%d.jpeg' % i), quality=95)
+    for i in range(findings):
+        rows = appendix_rows if appendix_every and (i + 1) % appendix_every == 0 else 0
+        with open(os.path.join(directory, 'findings', '%04d.md' % i), 'w', encoding='utf-8') as f:
+            f.write(finding(i, rows))
+
+def pages(docx):
+    with zipfile.ZipFile(docx) as z:
+        xml = z.read('word/document.xml').decode('utf-8')
+    text = sum(len(t) for t in re.findall(r'<w:t(?: [^>]*)?>([^<]*)</w:t>', xml))
+    return max(1, round(text / PAGE_CHARS))
+
+def run(directory, renderer, args):
+    command = [sys.executable, os.path.abspath(MD2DOCX), 'report.docx',
+        '--files', os.path.join('findings', '*.md'), '--renderer', renderer,
+        '--highlighter', args.highlighter, '--jobs', str(args.jobs),
+        '--no-cache', '--profile-json', 'profile.json']
+    start = time.perf_counter()
+    subprocess.run(command, cwd=directory, check=True, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    with open(os.path.join(directory, 'profile.json')) as f:
+        profile = json.load(f)
+    peak_rss = max(profile.get('peak_rss', 0), profile.get('peak_rss_children', 0))
+    stages = {name: t['wall'] for name, t in profile['stages'].items()}
+    return wall, peak_rss, stages
+
+def benchmark(renderer, findings, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        write_report(tmp, findings, args.appendix_every, args.appendix_rows)
+        runs = [run(tmp, renderer, args) for _ in range(args.repeat)]
+        n = pages(os.path.join(tmp, 'report.docx'))
+    walls = [r[0] for r in runs]
+    # The median run, so one slow or lucky run does not decide the result
+    wall, peak_rss, stages = sorted(runs)[len(runs) // 2]
+    return {'findings': findings, 'pages': n, 'wall': wall, 'wall_stdev': statistics.pstdev(walls),
+        'peak_rss': peak_rss, 'stages': stages}
+
+arg_parser = argparse.ArgumentParser(description='Benchmark md2docx on synthetic reports and check for regressions')
+arg_parser.add_argument('--findings', type=int, nargs='+', default=[10, 50], help='Report sizes, in findings')
+arg_parser.add_argument('--renderers', nargs='+', default=['markdown', 'html'], choices=['markdown', 'html'])
+arg_parser.add_argument('--highlighter', default='prism')
+arg_parser.add_argument('--jobs', type=int, default=1, help='Passed on to md2docx')
+arg_parser.add_argument('--appendix-every', type=int, default=10, help='Give every Nth finding a large scan results table')
+arg_parser.add_argument('--appendix-rows', type=int, default=500, help='Rows in a scan results table')
+arg_parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario; the median is kept')
+arg_parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON file')
+arg_parser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+arg_parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown against the baseline, as a fraction')
+arg_parser.add_argument('--memory-threshold', type=float, default=0.2, help='Allowed peak memory growth against the baseline, as a fraction')
+args = arg_parser.parse_args()
+
+baseline = {}
+if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+results = {}
+regressions = []
+print('%-14s %8s %6s %8s %10s %8s %8s %10s %8s' % ('scenario', 'findings', 'pages', 'wall s',
+    'findings/s', 'pages/s', 'peak MB', 'base s', 'change'))
+for renderer in args.renderers:
+    for findings in args.findings:
+        name = '%s-%d' % (renderer, findings)
+        r = results[name] = benchmark(renderer, findings, args)
+        base = baseline.get(name)
+        change = ''
+        if base is not None:
+            change = '%+.0f%%' % ((r['wall'] / base['wall'] - 1) * 100)
+            if r['wall'] > base['wall'] * (1 + args.threshold):
+                regressions.append('%s: %.2fs against %.2fs' % (name, r['wall'], base['wall']))
+            if base['peak_rss'] and r['peak_rss'] > base['peak_rss'] * (1 + args.memory_threshold):
+                regressions.append('%s: peak %.1f MB against %.1f MB' % (name,
+                    r['peak_rss'] / 2**20, base['peak_rss'] / 2**20))
+        print('%-14s %8d %6d %8.2f %10.1f %8.1f %8.1f %10s %8s' % (name, findings, r['pages'],
+            r['wall'], findings / r['wall'], r['pages'] / r['wall'], r['peak_rss'] / 2**20,
+            '%.2f' % base['wall'] if base else '-', change))
+        print('  ' + ', '.join('%s %.2f' % s for s in r['stages'].items()))
+
+if args.save:
+    baseline.update(results)
+    with open(args.baseline, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    print('Saved the baseline to %s' % args.baseline)
+elif regressions:
+    print('Regressions beyond the thresholds:')
+    for r in regressions:
+        print('  ' + r)
+    sys.exit(1)
+elif not baseline:
+    print('No baseline to compare with, record one with --save')
@@ -2,36 +2,135 @@
 
 # MD > HTML
 import mistletoe
+from mistletoe import block_token, span_token
+from mistletoe.base_renderer import BaseRenderer
+from mistletoe.block_token import HTMLBlock
+from mistletoe.span_token import HTMLSpan
 # HTML parser
 from bs4 import BeautifulSoup as bs
 from bs4.element import Tag, NavigableString
-from prism import highlight
+import prism
 # DOCX
 from docx import Document
-from docx.shared import Pt, Inches, RGBColor
+from docx.shared import Emu, Pt, Inches, RGBColor
+from docx.enum.style import WD_STYLE_TYPE
+from docx.styles.style import StyleFactory
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_UNDERLINE
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
-from docx.opc.constants import RELATIONSHIP_TYPE
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, qn
+from docx.oxml.numbering import CT_Num
+from docx.opc.constants import CONTENT_TYPE, RELATIONSHIP_TYPE
+from docx.opc.packuri import PACKAGE_URI
+from docx.table import Table, _Cell
 from docx.text.run import Run
+from lxml import etree
 # Utils
 import argparse
+import base64
+from collections import deque
+import cProfile
+from copy import deepcopy
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache, partial
+from itertools import chain
 import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import html
+import io
+import json
+import multiprocessing
 import os
+import shutil
+import signal
+import socketserver
+import re
+import soupsieve
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import zipfile
+import zlib
+import PIL
 from PIL import Image, ImageOps
 from colour import Color
+try:
+    import resource
+except ImportError:
+    # Not on Windows; profiles then leave out the peak RSS
+    resource = None
 
 DOC_TEXT_WIDTH = "450pt"
-COLOR_SYN_BLUE = "#057d9f"
-
+DEFAULT_JOBS = min(4, os.cpu_count() or 1)
+DEFAULT_IMAGE_DPI = 200
+DEFAULT_JPEG_QUALITY = 85
+# Seconds between polls of the watched files
+WATCH_INTERVAL = 0.3
+# Seconds a --serve request may take, queueing included
+SERVE_TIMEOUT = 60
+# --serve latencies kept for the percentiles in /metrics
+SERVE_LATENCIES = 1000
+# zlib level of the parts of saved documents
+DEFAULT_COMPRESSION = 6
+# Parts that are compressed already, and saved without compressing them again
+STORED_TYPES = {CONTENT_TYPE.JPEG, CONTENT_TYPE.PNG, CONTENT_TYPE.GIF}
+# Size of the pieces large parts are deflated in, in parallel
+DEFLATE_CHUNK = 1024 * 1024
+# Sizes and offsets in a zip file without ZIP64, and 1980-01-01, its first date
+ZIP_LIMIT = 0xFFFFFFFF
+ZIP_DATE = 33
+# Nesting levels the List Bullet and List Number styles of the template go to
+LIST_LEVELS = 3
+# Tags that end the text of a list item, see HtmlToDocx.render_list()
+LIST_ITEM_BLOCKS = {'p', 'ul', 'ol', 'pre', 'table', 'blockquote', 'div', 'hr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+# HTML tags of the block tokens, see block_name()
+BLOCK_NAMES = {'Paragraph': 'p', 'Table': 'table', 'Quote': 'blockquote', 'ThematicBreak': 'hr'}
+DOCX_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+DEFAULT_THEME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'themes', 'default.json')
+
+HIGHLIGHT_TOKEN = re.compile(r'<span\b[^>]*>|</span>|[^<]+')
+HIGHLIGHT_STYLE = re.compile(r'style="([^"]*)"')
+# Characters that mean something in Markdown text
+MARKDOWN_SPECIAL = re.compile(r'([\\`*_\[\]<>#!|])')
+SELECTOR_TAG = re.compile(r'[a-zA-Z][\w-]*')
+SELECTOR_SIMPLE = re.compile(r'([.:])([\w-]+)(?:\(((?:[^()]|\([^()]*\))*)\))?')
+SELECTOR_NTH = re.compile(r'(even)$|(odd)$|([+-]?\d*)n([+-]\d+)?$|([+-]?\d+)$')
+# Start of a table as python-docx's add_table writes it
+TABLE_XML = ('<w:tbl %s><w:tblPr><w:tblW w:type="auto" w:w="0"/>'
+    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0"'
+    ' w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+    '<w:tblGrid>%s</w:tblGrid>')
+
+@lru_cache(maxsize=None)
 def font_size(sz):
     return Pt(float(sz.split('pt')[0]))
 
+@lru_cache(maxsize=None)
 def font_color(c):
     color = Color(c.strip())
     rgb = color.rgb
     return RGBColor(int(rgb[0]*255), int(rgb[1]*255), int(rgb[2]*255))
 
+def run_format(style, bold=False, italic=False):
+    # Everything about a style that shows in a run: font, size, colour,
+    # underline, bold and italic
+    return (style.get('font-family'),
+        font_size(style['font-size']) if 'font-size' in style else None,
+        font_color(style['color']) if 'color' in style else None,
+        style.get('text-decoration-line') == 'underline',
+        bold or style.get('font-weight') == 'bold',
+        italic)
+
+def without_color(fmt):
+    return fmt[:2] + fmt[3:]
+
 def par_align(j):
     match j:
         case 'justify':
@@ -108,61 +207,93 @@ def set_paragraph_border(par, **kwargs):
                 if key in edge_data:
                     element.set(qn('w:{}'.format(key)), str(edge_data[key]))
 
-def set_cell_border(c, **kwargs):
+@lru_cache(maxsize=None)
+def cell_properties(background=None, border_top=None, border_bottom=None):
+    # w:tcPr children for cell borders and shading, in schema order
+    borders = ''
+    for edge, border in (('top', border_top), ('bottom', border_bottom)):
+        if border is not None:
+            sz,_,color = border.split(' ')
+            borders += '<w:%s w:color="%s" w:space="0" w:sz="%d" w:val="single"/>' % (
+                edge, color[1:], int(sz[:-2])*2)
+    xml = ''
+    if borders != '':
+        xml += '<w:tcBorders>%s</w:tcBorders>' % borders
+    if background is not None:
+        xml += '<w:shd w:fill="%s"/>' % background[1:]
+    return xml
+
+def process_image(data, width, dpi, quality):
     """
-    Set cell`s border
-    Usage:
-
-    set_cell_border(
-        cell,
-        top={"sz": 12, "val": "single", "color": "#FF0000", "space": "0"},
-        bottom={"sz": 12, "color": "#00FF00", "val": "single"},
-        start={"sz": 24, "val": "dashed", "shadow": "true"},
-        end={"sz": 12, "val": "dashed"},
-    )
+    Shrink image bytes for embedding at `width` (a Length): rotate them
+    upright according to their EXIF orientation, downscale them to at
+    most `dpi` and recompress them. Formats other than JPEG and PNG are
+    left alone, and so is an upright image that would not get smaller
+    (downscaled text in screenshots can make a PNG bigger).
     """
-    tc = c._tc
-    tcPr = tc.get_or_add_tcPr()
-
-    # check for tag existance, if none found, then create one
-    tcBorders = tcPr.first_child_found_in("w:tcBorders")
-    if tcBorders is None:
-        tcBorders = OxmlElement('w:tcBorders')
-        tcPr.append(tcBorders)
-
-    # list over all available tags
-    for edge in ('start', 'top', 'end', 'bottom', 'insideH', 'insideV'):
-        edge_data = kwargs.get(edge)
-        if edge_data:
-            if 'color' in edge_data:
-                color = edge_data['color'][1:]
-                edge_data['color'] = color
-            if 'sz' in edge_data:
-                sz = int(edge_data['sz'][:-2])
-                edge_data['sz'] = str(sz*2)
-
-            tag = 'w:{}'.format(edge)
-
-            # check for tag existnace, if none found, then create one
-            element = tcBorders.find(qn(tag))
-            if element is None:
-                element = OxmlElement(tag)
-                tcBorders.append(element)
-            # looks like order of attributes is important
-            for key in ["color", "space", "sz", "val", "shadow"]:
-                if key in edge_data:
-                    element.set(qn('w:{}'.format(key)), str(edge_data[key]))
-
-def set_cell_bg_color(c, color):
-    color = color[1:]
-    tblCell = c._tc
-    tblCellProperties = tblCell.get_or_add_tcPr()
-    shading = OxmlElement('w:shd')
-    shading.set(qn('w:fill'), color)
-    tblCellProperties.append(shading)
-
-def dict_to_style(dict):
-    return ';'.join(['%s:%s' % (key, value) for (key, value) in dict.items()])
+    try:
+        image = Image.open(io.BytesIO(data))
+    except (Image.UnidentifiedImageError, OSError):
+        return data
+    fmt = image.format
+    if fmt not in ('JPEG', 'PNG') or getattr(image, 'is_animated', False):
+        return data
+
+    rotated = image.getexif().get(0x0112, 1) != 1
+    image = ImageOps.exif_transpose(image)
+    max_width = int(width.inches * dpi)
+    if image.width > max_width:
+        if image.mode in ('1', 'P'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        height = max(1, round(image.height * max_width / image.width))
+        image = image.resize((max_width, height), Image.Resampling.LANCZOS)
+
+    out = io.BytesIO()
+    options = {'optimize': True}
+    if image.info.get('icc_profile'):
+        options['icc_profile'] = image.info['icc_profile']
+    if fmt == 'JPEG':
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        image.save(out, 'JPEG', quality=quality, **options)
+    else:
+        image.save(out, 'PNG', **options)
+    if not rotated and out.tell() >= len(data):
+        return data
+    return out.getvalue()
+
+def load_images(srcs, dpi=DEFAULT_IMAGE_DPI, quality=DEFAULT_JPEG_QUALITY, jobs=1, cache=None):
+    """
+    Read each distinct image file once and shrink it with process_image
+    for the text width, over `jobs` threads (Pillow releases the GIL
+    while decoding and resizing). Results are kept in `cache` (a
+    FileCache) by content, so unchanged images are not processed again;
+    trimming it is left to the caller.
+    Returns a dict mapping each src to the bytes to embed.
+    """
+    width = font_size(DOC_TEXT_WIDTH)
+
+    def load(src):
+        with open(src, 'rb') as f:
+            data = f.read()
+        if cache is None:
+            return process_image(data, width, dpi, quality)
+        h = hashlib.sha256()
+        h.update(('%s %d %d %d\0' % (PIL.__version__, width, dpi, quality)).encode())
+        h.update(data)
+        key = h.hexdigest()
+        processed = cache.read(key)
+        if processed is None:
+            processed = process_image(data, width, dpi, quality)
+            cache.write(key, processed)
+        return processed
+
+    srcs = list(dict.fromkeys(srcs))
+    if len(srcs) == 0:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(srcs)))) as executor:
+        images = dict(zip(srcs, executor.map(load, srcs)))
+    return images
 
 def style_to_dict(style):
     d = {}
@@ -172,265 +303,502 @@ def style_to_dict(style):
         d[k] = v
     return d
 
-def get_style(tag):
-    style = {}
-    tags = []
-    # Build tag stack
-    while tag.parent:
-        tags.append(tag)
-        tag = tag.parent
-    # Traverse tag stack and build style object
-    while len(tags) > 0:
-        tag = tags.pop()
-        if not tag.name is None and 'style' in tag.attrs:
-            style.update(style_to_dict(tag['style']))
+class StyleContext:
+    """
+    Computed style of a node in the HTML tree: the cascaded properties of
+    its ancestors plus whether it is inside bold or italic tags. Contexts
+    are immutable and shared, and a tag that adds nothing reuses its
+    parent's, so text runs cost the same however deep they are nested.
+    """
+    __slots__ = ('style', 'bold', 'italic')
+
+    def __init__(self, style=None, bold=False, italic=False):
+        self.style = {} if style is None else style
+        self.bold = bold
+        self.italic = italic
+
+    def enter(self, tag):
+        style = tag.attrs.get('style')
+        bold = self.bold or tag.name in ('strong', 'b')
+        italic = self.italic or tag.name in ('em', 'i')
+        if not style and bold == self.bold and italic == self.italic:
+            return self
+        if isinstance(style, str):
+            style = style_to_dict(style)
+        if style:
+            style = {**self.style, **style}
+        else:
+            style = self.style
+        return StyleContext(style, bold, italic)
+
+ROOT_CONTEXT = StyleContext()
+
+def merge_style(style, update):
+    # A None value removes the property
+    for k, v in update.items():
+        if v is None: style.pop(k, None)
+        else: style[k] = v
     return style
 
+def split_selector(selector, separators):
+    # Split on separators outside of brackets, so "p:has(a, b)" stays whole
+    parts = ['']
+    depth = 0
+    for ch in selector:
+        if ch in '([': depth += 1
+        elif ch in ')]': depth -= 1
+        if depth == 0 and ch in separators: parts.append('')
+        else: parts[-1] += ch
+    return [p.strip() for p in parts if p.strip() != '']
+
+def selector_keys(selector):
+    # Tag names a selector can match, or '*' if it can match any tag
+    keys = set()
+    for s in split_selector(selector, ','):
+        m = SELECTOR_TAG.match(split_selector(s, ' >+~')[-1])
+        keys.add(m.group(0).lower() if m else '*')
+    return keys
+
+class Siblings:
+    """
+    Position of each tag among its parent's child tags, worked out once
+    per parent, so :nth-child() and sibling combinators never rescan the
+    rows of a long table.
+    """
+    def __init__(self):
+        self.positions = {}
+
+    def position(self, tag):
+        # (1-based index, number of siblings, previous sibling)
+        if id(tag) not in self.positions:
+            children = [c for c in tag.parent.children if isinstance(c, Tag)]
+            prev = None
+            for i, c in enumerate(children):
+                self.positions[id(c)] = (i + 1, len(children), prev)
+                prev = c
+        return self.positions[id(tag)]
+
+def is_element(tag):
+    # The BeautifulSoup object itself is not an element
+    return tag is not None and tag.parent is not None
+
+def parse_nth(arg):
+    m = SELECTOR_NTH.match((arg or '').replace(' ', ''))
+    if m is None:
+        raise ValueError('Unsupported :nth-child(%s)' % arg)
+    even, odd, a, b, n = m.groups()
+    if even: return 2, 0
+    if odd: return 2, 1
+    if n is not None: return 0, int(n)
+    a = {'': 1, '+': 1, '-': -1}.get(a, None) or int(a)
+    return a, int(b or 0)
+
+class Selector:
+    """
+    The CSS selectors themes use, compiled for Theme.apply: tag names,
+    classes, :first-child, :last-child, :nth-child(), :not() and
+    :has() with a single tag, joined by any of the four combinators.
+    Sibling positions come from a shared Siblings cache instead of
+    being counted per match like soupsieve does.
+    Raises ValueError for anything else.
+    """
+    def __init__(self, selector):
+        self.selectors = [self.parse_complex(s) for s in split_selector(selector, ',')]
+
+    def parse_complex(self, selector):
+        # [(combinator, compound), ...], combinator joining it to the previous one
+        parts = []
+        combinator = None
+        compound = ''
+        depth = 0
+        for ch in selector.strip() + ' ':
+            if depth == 0 and ch in ' >+~':
+                if compound != '':
+                    parts.append((combinator, self.parse_compound(compound)))
+                    compound = ''
+                    combinator = ' '
+                if ch != ' ':
+                    if len(parts) == 0: raise ValueError('Selector starts with %s' % ch)
+                    combinator = ch
+                continue
+            if ch == '(': depth += 1
+            elif ch == ')': depth -= 1
+            compound += ch
+        if len(parts) == 0 or compound != '' or combinator not in (None, ' '):
+            raise ValueError('Incomplete selector: %s' % selector)
+        return parts
+
+    def parse_compound(self, compound):
+        name = None
+        i = 0
+        if compound.startswith('*'):
+            i = 1
+        elif SELECTOR_TAG.match(compound):
+            name = SELECTOR_TAG.match(compound).group(0).lower()
+            i = len(name)
+        classes = []
+        tests = []
+        while i < len(compound):
+            m = SELECTOR_SIMPLE.match(compound, i)
+            if m is None:
+                raise ValueError('Unsupported selector: %s' % compound)
+            kind, ident, arg = m.groups()
+            i = m.end()
+            if kind == '.' and arg is None: classes.append(ident)
+            elif ident == 'first-child': tests.append(('nth', (0, 1)))
+            elif ident == 'last-child': tests.append(('last', None))
+            elif ident == 'nth-child': tests.append(('nth', parse_nth(arg)))
+            elif ident == 'not': tests.append(('not', Selector(arg)))
+            elif ident == 'has':
+                arg = arg.strip()
+                child = arg.startswith('>')
+                inner = self.parse_complex(arg.removeprefix('>'))
+                if len(inner) != 1:
+                    raise ValueError('Unsupported :has(%s)' % arg)
+                tests.append(('has', (child, inner[0][1])))
+            else:
+                raise ValueError('Unsupported selector: %s' % compound)
+        return name, classes, tests
+
+    def match(self, tag, siblings):
+        return any(self.match_complex(parts, len(parts) - 1, tag, siblings)
+            for parts in self.selectors)
+
+    def match_compound(self, compound, tag, siblings):
+        name, classes, tests = compound
+        if name is not None and tag.name != name:
+            return False
+        if len(classes) > 0:
+            tag_classes = tag.get('class') or []
+            if any(c not in tag_classes for c in classes):
+                return False
+        for kind, arg in tests:
+            if kind == 'nth':
+                a, b = arg
+                i = siblings.position(tag)[0] - b
+                if not (i == 0 if a == 0 else i % a == 0 and i // a >= 0):
+                    return False
+            elif kind == 'last':
+                i, n, _ = siblings.position(tag)
+                if i != n:
+                    return False
+            elif kind == 'not':
+                if arg.match(tag, siblings):
+                    return False
+            elif kind == 'has':
+                child, inner = arg
+                if not any(self.match_compound(inner, t, siblings)
+                        for t in tag.find_all(True, recursive=not child)):
+                    return False
+        return True
+
+    def match_complex(self, parts, i, tag, siblings):
+        combinator, compound = parts[i]
+        if not self.match_compound(compound, tag, siblings):
+            return False
+        if i == 0:
+            return True
+        if combinator == '>':
+            return is_element(tag.parent) and self.match_complex(parts, i - 1, tag.parent, siblings)
+        if combinator == ' ':
+            parent = tag.parent
+            while is_element(parent):
+                if self.match_complex(parts, i - 1, parent, siblings):
+                    return True
+                parent = parent.parent
+            return False
+        prev = siblings.position(tag)[2]
+        if combinator == '+':
+            return prev is not None and self.match_complex(parts, i - 1, prev, siblings)
+        while prev is not None:
+            if self.match_complex(parts, i - 1, prev, siblings):
+                return True
+            prev = siblings.position(prev)[2]
+        return False
+
+class Theme:
+    """
+    Named styles, shared by both renderers, and the rules that apply them
+    to the HTML tree, loaded from a JSON theme file (themes/default.json).
+    A style may "extend" another one, and a null property removes that
+    property when the style is merged into a tag.
+
+    Rules are [selector, "set" | "merge", style name] triples. A tag
+    gets the rules matching it applied in file order, so a later rule
+    overrides an earlier one like a later pass over the tree would.
+    """
+    def __init__(self, path=DEFAULT_THEME):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        # Identifies the theme in build caches
+        self.digest = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        self.styles = {}
+        for name in data['styles']:
+            self.resolve(name, data['styles'])
+
+        # Rules bucketed by the tag name they end in, with their position
+        # so buckets can be merged back into file order
+        self.rules = {}
+        for order, (selector, op, name) in enumerate(data.get('rules', [])):
+            if op not in ('set', 'merge'):
+                raise Exception('Unknown style rule operation: %s' % op)
+            try:
+                match = Selector(selector).match
+            except ValueError:
+                # soupsieve covers the rest of CSS, at the cost of counting
+                # siblings for every tag it matches
+                compiled = soupsieve.compile(selector)
+                match = lambda tag, siblings, compiled=compiled: compiled.match(tag)
+            rule = (match, op == 'merge', self.styles[name])
+            for key in selector_keys(selector):
+                self.rules.setdefault(key, []).append((order, rule))
+        self.candidates = {}
+
+    def __getitem__(self, name):
+        return self.styles[name]
+
+    def resolve(self, name, styles, seen=()):
+        if name in seen:
+            raise Exception('Style %s extends itself' % name)
+        if name not in self.styles:
+            style = dict(styles[name])
+            parent = style.pop('extends', None)
+            if parent is not None:
+                style = {**self.resolve(parent, styles, seen + (name,)), **style}
+            self.styles[name] = style
+        return self.styles[name]
+
+    def heading(self, level):
+        return self.styles['h%d' % min(level, 4)]
+
+    def rules_for(self, name):
+        if name not in self.candidates:
+            rules = dict(sorted(self.rules.get(name, []) + self.rules.get('*', []),
+                key=lambda r: r[0]))
+            self.candidates[name] = list(rules.values())
+        return self.candidates[name]
+
+    def apply(self, soup):
+        """
+        Style every tag in one walk over the tree, only testing the rules
+        that can match its name. Styles are left on the tags as dicts.
+        """
+        base = self.styles['base']
+        siblings = Siblings()
+        for tag in soup.find_all(True):
+            style = tag.attrs.get('style')
+            if isinstance(style, str):
+                style = style_to_dict(style)
+            for match, merge, rule_style in self.rules_for(tag.name):
+                if not match(tag, siblings):
+                    continue
+                if not merge:
+                    style = dict(rule_style)
+                else:
+                    style = merge_style(dict(base) if style is None else style, rule_style)
+            if style is not None:
+                tag['style'] = style
+
 def table_dimensions(table):
     rows = len(table.find_all('tr'))
     cols = len(table.tr.select('th,td'))
     return rows, cols
 
-def generate_reqres(contents):
-    table = '''<table class="reqres">
-            <thead>
-            <tr>
-                <th style="" colspan=2><b>Reproduction example</b></th><th style=""></th>
-            </tr>
-            </thead>
-            <tbody>{}</tbody>
-        </table>'''
-    rows = ''
+def reqres_rows(contents):
+    # Each row starts with "--- Key | optional blurb" followed by its body
+    rows = []
     for key, val in [s.split('\n', 1) for s in contents.split('--- ')[1:]]:
-        blurb =''
+        blurb = ''
         if '|' in key: key, blurb = key.split('|', 1)
-        row = '''<tr>
-                <td style="width:50pt"><b>{}</b><i style="font-size:10pt">{}</i></td>
-                <td style="width:400pt">
-                    <pre><code class="language-http">{}</code></pre>
-                </td>
-            </tr>'''.format(key.strip(),'\n'+blurb.strip(),val.strip())
-        rows += row
-    return table.format(rows)
-
-def apply_html_style(soup):
-    # Global
-    base_style = {
-        'font-family': 'Calibri',
-        'font-size': '11pt'
-    }
-
-    # Parse custom reproduction example code block
-    # to HTML table for later styling
+        rows.append((key.strip(), blurb.strip(), val.strip()))
+    return rows
+
+class BodyLimit:
+    """
+    How reqres blocks show messages longer than `chars` characters: cut
+    off after `chars`, or with `elide` the middle is left out instead,
+    keeping the start and the end. A marker says how much was left out;
+    with `appendix` the whole message is added to an appendix at the end
+    of the document.
+    """
+    def __init__(self, chars=None, elide=False, appendix=False):
+        self.chars = chars
+        self.elide = elide
+        self.appendix = appendix
+
+    def __repr__(self):
+        # Identifies the limit in build caches
+        return 'BodyLimit(%r, elide=%r, appendix=%r)' % (self.chars, self.elide, self.appendix)
+
+    def shorten(self, body):
+        """
+        Split body into the start to show, a marker for the part left out
+        and the end to show. The marker and end are '' when body fits.
+        """
+        if self.chars is None or len(body) <= self.chars:
+            return body, '', ''
+        if self.elide:
+            head = body[:self.chars // 2]
+            tail = body[len(body) - self.chars // 2:] if self.chars > 1 else ''
+        else:
+            head, tail = body[:self.chars], ''
+        # Cut at a line end, unless that loses most of what is shown
+        i = head.rfind('\n')
+        if i >= len(head) // 2:
+            head = head[:i + 1]
+        i = tail.find('\n')
+        if 0 <= i < len(tail) // 2:
+            tail = tail[i + 1:]
+        marker = '[... %s characters left out%s ...]' % ('{:,}'.format(len(body) - len(head) - len(tail)),
+            ', see the appendix' if self.appendix else '')
+        if head != '' and not head.endswith('\n'):
+            marker = '\n' + marker
+        if tail != '':
+            marker += '\n'
+        return head, marker, tail
+
+NO_BODY_LIMIT = BodyLimit()
+
+def reqres_title(rows, key):
+    # What an appendix entry of a reqres block is listed under
+    first = rows[0][2].split('\n', 1)[0] if len(rows) > 0 else ''
+    return '%s of %s' % (key, first) if first != '' else key
+
+def appendix_markdown(bodies):
+    # The (title, body) messages left out of reqres blocks, as Markdown
+    lines = ['# Appendix: Full HTTP messages', '']
+    for title, body in bodies:
+        # A fence longer than any run of backticks in the body
+        fence = '`' * max([3] + [len(m) + 1 for m in re.findall('`+', body)])
+        lines.extend(['## ' + MARKDOWN_SPECIAL.sub(r'\\\1', title), '', fence, body, fence, ''])
+    return '\n'.join(lines)
+
+def reqres_table(soup, contents, body_limit=NO_BODY_LIMIT, appendix=None):
+    """
+    The table of a reqres block, built straight into soup's tree. Messages
+    left out by body_limit are added to the list appendix as (title, body).
+    """
+    def tag(name, *children, **attrs):
+        t = soup.new_tag(name, attrs=attrs)
+        for c in children:
+            t.append(c)
+        return t
+
+    head = tag('thead', tag('tr', tag('th', tag('b', 'Reproduction example'), style='', colspan='2'),
+        tag('th', style='')))
+    body = tag('tbody')
+    rows = reqres_rows(contents)
+    for key, blurb, val in rows:
+        shown, marker, tail = body_limit.shorten(val)
+        code = tag('pre', tag('code', shown, **{'class': ['language-http']}))
+        if marker != '':
+            code.append(tag('code', marker, **{'class': ['omitted']}))
+            if tail != '':
+                code.append(tag('code', tail))
+            if body_limit.appendix and appendix is not None:
+                appendix.append((reqres_title(rows, key), val))
+        body.append(tag('tr', tag('td', tag('b', key), tag('i', '\n' + blurb, style='font-size:10pt'),
+            style='width:50pt'), tag('td', code, style='width:400pt')))
+    return tag('table', head, body, **{'class': ['reqres']})
+
+def code_language(tag):
+    for c in tag.attrs.get('class', []):
+        if c.startswith('language-'):
+            return c.removeprefix('language-')
+    return ''
+
+def highlight_code_blocks(soup, jobs=1, cache=None, highlighter='prism'):
+    # Highlight every distinct code block up front so the style pass
+    # below only has to splice in the results
+    blocks = []
+    for t in soup.select('pre > code'):
+        lang = code_language(t)
+        if lang != '':
+            blocks.append((t.get_text(), lang))
+    return prism.highlight_many(blocks, jobs, cache, highlighter)
+
+def apply_html_style(soup, highlight_jobs=1, highlight_cache=None, highlighter='prism', theme=None, profile=None,
+        body_limit=NO_BODY_LIMIT, previous=None):
+    # Returns the (title, body) messages that body_limit left out of
+    # reqres blocks, for the appendix. previous is the tag name of the
+    # block before soup's, if soup continues another document
+    if theme is None:
+        theme = Theme()
+    if profile is None:
+        profile = Profile()
+    appendix = []
+
+    # Turn custom reproduction example code blocks into tables for later styling
     for t in soup.select('pre > code.language-reqres'):
-        inner_html = generate_reqres(t.get_text())
-        new_soup = bs(inner_html, 'html.parser')
-        t.parent.replace_with(new_soup)
-
-    # Text
-    for t in soup.select('p, th, td, li'):
-        style = base_style.copy()
-        style['text-align'] = 'justify'
-        t['style'] = dict_to_style(style)
-
-    # Inline Code
-    for t in soup.find_all('code'):
-        style = base_style.copy()
-        style['font-family'] = 'Roboto Mono'
-        style['font-size'] = '9pt'
-        t['style'] = dict_to_style(style)
-
-    # Hyperlinks
-    for t in soup.find_all('a'):
-        style = base_style.copy()
-        style['color'] = '#1155cc'
-        style['text-decoration-line'] = 'underline'
-        t['style'] = dict_to_style(style)
-
-    # Code blocks
+        t.parent.replace_with(reqres_table(soup, t.get_text(), body_limit, appendix))
+
+    # Apply Prism syntax highlighting to code blocks
+    with profile.stage('highlight'):
+        highlighted = highlight_code_blocks(soup, highlight_jobs, highlight_cache, highlighter)
     for t in soup.select('pre > code'):
-        style = base_style.copy()
-        style['font-family'] = 'Roboto Mono'
-        style['font-size'] = '9pt'
-        style['text-align'] = 'left'
-        style['border'] = '1px solid #000000'
-        t['style'] = dict_to_style(style)
-
-        # Apply Prism syntax highlighting
-        lang = ''
-        if 'class' in t.attrs:
-            lang = t['class'][0].removeprefix('language-')
+        lang = code_language(t)
         code = t.get_text()
         t.clear()
         if lang == '':
-            inner_html = code
-        else:
-            inner_html = highlight(code, lang)
-        new_soup = bs(inner_html, 'html.parser')
-        t.append(new_soup)
-
-    # Image
-    for i in soup.find_all('img'):
-        style = base_style.copy()
-        style['width'] = DOC_TEXT_WIDTH
-        style['border'] = '1px solid #000000'
-        i['style'] = dict_to_style(style)
-
-    # Captions
-    for p in soup.select('p:has(img), pre + p, table + p'):
-        style = base_style.copy()
-        style['font-size'] = '10pt'
-        style['text-align'] = 'center'
-        p['style'] = dict_to_style(style)
-        for t in p.find_all('code'):
-            style = base_style.copy()
-            if 'style' in t.attrs:
-                style = style_to_dict(t['style'])
-            style['font-size'] = '8pt'
-            t['style'] = dict_to_style(style)
-
-
-    # Headings
-    heading_style = base_style.copy()
-    heading_style['color'] = '#666666'
-    heading_style['text-align'] = 'left'
-
-    for t in soup.find_all('h1'):
-        style = heading_style.copy()
-        style['font-size'] = '20pt'
-        style['font-weight'] = 'bold'
-        t['style'] = dict_to_style(style)
-
-    for t in soup.find_all('h2'):
-        style = heading_style.copy()
-        style['font-size'] = '18pt'
-        style['font-weight'] = 'bold'
-        t['style'] = dict_to_style(style)
-        
-    for t in soup.find_all('h3'):
-        style = heading_style.copy()
-        style['font-size'] = '14pt'
-        style['font-weight'] = 'bold'
-        style['color'] = '#434343'
-        t['style'] = dict_to_style(style)
-
-    for t in soup.find_all('h4'):
-        style = heading_style.copy()
-        style['font-size'] = '12pt'
-        t['style'] = dict_to_style(style)
-
-    # Tables
-    table_style = base_style.copy()
-    table_style['border-collapse'] = 'collapse'
-
-    ## Remove empty table heads
+            t.append(code)
+            continue
+        # Tags built one by one; appending a parsed soup would move its
+        # children over at a cost that grows with their number
+        for text, style in highlighted_runs(highlighted[(code, lang)]):
+            if style:
+                t.append(soup.new_tag('span', attrs={'style': dict(style)}))
+                t.contents[-1].append(text)
+            else:
+                t.append(text)
+
+    # Remove empty table heads
     for t in soup.find_all('table'):
         header_empty = True
         if not t.thead:
-            break
+            continue
         for th in t.thead.tr:
             if not th.text.rstrip() == '':
                 header_empty = False
                 break
         if header_empty:
             t.thead.decompose()
-    ## Remove those weird alignment attributes on every table cell
-    for t in soup.select('tr > *'):
-        if 'align' in t.attrs: del t['align']
-        ## Force left-alignment on table cells
-        style = style_to_dict(t['style'])
-        style['text-align'] = 'left'
-        t['style'] = dict_to_style(style)
-    ## All tables
-    for t in soup.find_all('table'):
-        t['style'] = dict_to_style(table_style)
-    ## Summary tables
-    for t in soup.select("h2 + table"):
-        ### Top row
-        for c in t.tr.find_all('td'):
-            if 'style' in c.attrs: style = style_to_dict(c['style'])
-            else: style = base_style.copy()
-            style['border-top'] = '6px solid %s' % COLOR_SYN_BLUE
-            c['style'] = dict_to_style(style)
-        for r in t.tbody.find_all('tr'):
-            ### First column
-            c = r.td
-            if 'style' in c.attrs: style = style_to_dict(c['style'])
-            else: style = base_style.copy()
-            style['text-align'] = 'right'
-            style['color'] = '#ffffff'
-            style['background-color'] = COLOR_SYN_BLUE
-            style['width'] = '82.512pt'
-            style['border-top'] = '6px solid %s' % COLOR_SYN_BLUE
-            c['style'] = dict_to_style(style)
-            ### Second column
-            c = r.select('td:nth-child(2)')[0]
-            if 'style' in c.attrs: style = style_to_dict(c['style'])
-            else: style = base_style.copy()
-            style['width'] = '367.488pt'
-            c['style'] = dict_to_style(style)
-    ## Other tables
-    for t in soup.select("*:not(h2) + table"):
-        ### Top row
-        if t.thead:
-            for c in t.thead.find_all('th'):
-                if 'style' in c.attrs: style = style_to_dict(c['style'])
-                else: style = base_style.copy()
-                style['color'] = '#ffffff'
-                style['background-color'] = COLOR_SYN_BLUE
-                c['style'] = dict_to_style(style)
-        ### Every other row
-        for r in t.tbody.select('tr:nth-child(even)'):
-            for c in r.find_all('td'):
-                if 'style' in c.attrs: style = style_to_dict(c['style'])
-                else: style = base_style.copy()
-                style['background-color'] = '#efefef'
-                c['style'] = dict_to_style(style)
-    ## Request/response tables
-    for t in soup.select(".reqres"):
-        c = t.th
-        if 'style' in c.attrs: style = style_to_dict(c['style'])
-        else: style = base_style.copy()
-        style['font-size'] = '12pt'
-        c['style'] = dict_to_style(style)
-        for r in t.tbody.find_all('tr'):
-            ### First column
-            c = r.td
-            if 'style' in c.attrs: style = style_to_dict(c['style'])
-            else: style = base_style.copy()
-            style['width'] = '80pt'
-            style['font-size'] = '12pt'
-            style['color'] = '#434343'
-            c['style'] = dict_to_style(style)
-            ### Second column
-            c = r.select('td:nth-child(2)')[0]
-            if 'style' in c.attrs: style = style_to_dict(c['style'])
-            else: style = base_style.copy()
-            style['width'] = '370pt'
-            c['style'] = dict_to_style(style)
-        ### Every cell
-        for c in t.tbody.find_all('td'):
-            if 'style' in c.attrs: style = style_to_dict(c['style'])
-            else: style = base_style.copy()
-            style['border-bottom'] = '2px solid %s' % COLOR_SYN_BLUE
-            c['style'] = dict_to_style(style)
-        ### Every other row
-        for r in t.tbody.select('tr:nth-child(even)'):
-            for c in r.find_all('td'):
-                if 'style' in c.attrs: style = style_to_dict(c['style'])
-                else: style = base_style.copy()
-                del style['background-color']
-                c['style'] = dict_to_style(style)
-        
+    # Remove those weird alignment attributes on every table cell
+    for t in soup.select('tr > [align]'):
+        del t['align']
 
+    # Everything else is up to the theme's rules. A stand-in for the block
+    # before makes rules like "h2 + table" match as in the whole document
+    if previous is not None:
+        soup.insert(0, soup.new_tag(previous))
+    theme.apply(soup)
+    if previous is not None:
+        soup.contents[0].decompose()
+    return appendix
+
+
+
+class DocxWriter:
+    """
+    Document setup and python-docx styling shared by the renderers.
+    Subclasses provide self.doc.
+    """
+    def setup_document(self, template=None):
+        # template is a saved document that is already set up, see
+        # document_template()
+        # Character styles interned by character_style()
+        self.character_styles = {}
+        # Run properties by run_format() key, copied onto runs by add_runs()
+        self.run_properties = {}
+        # Image bytes to embed instead of the source files, see load_images()
+        self.images = {}
+        # Depth of the list being rendered, the list styles used so far and
+        # the next free numbering id, see list_style() and restart_numbering()
+        self.list_level = 0
+        self.list_styles = {}
+        self.next_num_id = None
+        if template is not None:
+            return Document(io.BytesIO(template))
 
-class HtmlToDocx:
-    def __init__(self, soup: bs):
-        self.soup = soup
-        self.doc = self.setup_document()
-        self.stack = []
-    
-    def setup_document(self):
         doc = Document()
 
         # Page setup
@@ -469,32 +837,130 @@ class HtmlToDocx:
 
         return doc
 
+    def character_style(self, style):
+        """
+        Id of a character style with the font, size, colour and underline
+        of `style`, added to the document the first time it is asked for,
+        so runs reference a shared style instead of repeating formatting.
+        """
+        key = run_format(style)[:4]
+        if key not in self.character_styles:
+            if key == (None, None, None, False):
+                self.character_styles[key] = None
+            else:
+                self.character_styles[key] = self.add_character_style(*key)
+        return self.character_styles[key]
+
+    def add_character_style(self, family, size, color, underline):
+        name = []
+        if family is not None: name.append(family)
+        if size is not None: name.append('%gpt' % size.pt)
+        if color is not None: name.append(str(color))
+        if underline: name.append('Underline')
+        # styles.add_style() would first scan every style for the name,
+        # which character_styles already keeps unique
+        s = StyleFactory(self.doc.styles.element.add_style_of_type(' '.join(name), WD_STYLE_TYPE.CHARACTER, False))
+        if family is not None: s.font.name = family
+        if size is not None: s.font.size = size
+        if color is not None: s.font.color.rgb = color
+        if underline: s.font.underline = WD_UNDERLINE.SINGLE
+        return s.style_id
+
     def strip_paragraph(self, p):
-        # Clear leading empty runs
+        # Clear leading and trailing newlines, which coalesced runs may
+        # share with text
         for r in p.runs:
-            if not r.text == '\n':
-                break
-            r.text = ''
-        # Clear trailing empty runs
+            text = r.text.lstrip('\n')
+            if text != r.text: r.text = text
+            if text != '': break
         for r in reversed(p.runs):
-            if not r.text == '\n':
-                break
-            r.text = ''
-
-    def apply_inline_style(self, r, style):
-        if 'font-family' in style:
-            r.font.name = style['font-family']
-        if 'font-size' in style:
-            r.font.size = font_size(style['font-size'])
+            text = r.text.rstrip('\n')
+            if text != r.text: r.text = text
+            if text != '': break
+
+    def list_style(self, ordered):
+        """
+        Style id and abstract numbering of List Bullet, List Bullet 2, ...
+        (or List Number ...) for the current depth, down to the deepest
+        level the template has a style for.
+        """
+        level = min(self.list_level, LIST_LEVELS)
+        key = (ordered, level)
+        if key not in self.list_styles:
+            name = 'List Number' if ordered else 'List Bullet'
+            if level > 1: name += ' %d' % level
+            style = self.doc.styles[name].element
+            num = self.doc.part.numbering_part.element.num_having_numId(style.pPr.numPr.numId.val)
+            self.list_styles[key] = (style.styleId, num.abstractNumId.val)
+        return self.list_styles[key]
+
+    def restart_numbering(self, abstract_id, start):
+        # Id of a new numbering instance counting from start, so every
+        # numbered list restarts instead of carrying on from the last one.
+        # numbering.add_num() would scan every instance for a free id
+        numbering = self.doc.part.numbering_part.element
+        if self.next_num_id is None:
+            self.next_num_id = next_id(numbering.xpath('w:num/@w:numId'))
+        num = CT_Num.new(self.next_num_id, abstract_id)
+        num.add_lvlOverride(0).add_startOverride(start)
+        numbering.append(num)
+        self.next_num_id += 1
+        return num.numId
+
+    def set_list_style(self, p, style_id, num_id=None):
+        # Set on the XML, as p.style looks up the default style every time
+        p._p.style = style_id
+        if num_id is not None:
+            num_pr = p._p.get_or_add_pPr().get_or_add_numPr()
+            num_pr.get_or_add_ilvl().val = 0
+            num_pr.get_or_add_numId().val = num_id
+
+    def add_runs(self, p, pieces):
+        """
+        Add (text, style, bold, italic) pieces to paragraph p, merging
+        neighbours that end up with the same formatting into one run.
+        """
+        runs = []
+        for text, style, bold, italic in pieces:
+            if text == '': continue
+            key = run_format(style, bold, italic)
+            blank = text.isspace()
+            if len(runs) > 0:
+                last = runs[-1]
+                if last[0] == key:
+                    last[1].append(text)
+                    last[5] = last[5] and blank
+                    continue
+                # Whitespace looks the same in any colour, so it can join
+                # the run before or after it
+                if (blank or last[5]) and not key[3] and without_color(last[0]) == without_color(key):
+                    last[1].append(text)
+                    if not blank:
+                        last[0], last[2:6] = key, [style, bold, italic, False]
+                    continue
+            runs.append([key, [text], style, bold, italic, blank])
+        for key, texts, style, bold, italic, _ in runs:
+            r = p.add_run(''.join(texts))
+            # The key decides the properties, and copying them is much
+            # cheaper than setting them through python-docx for every run
+            rpr = self.run_properties.get(key)
+            if rpr is None:
+                self.apply_inline_style(r, style, bold, italic)
+                self.run_properties[key] = deepcopy(r._r.rPr)
+            else:
+                r._r.insert(0, deepcopy(rpr))
+
+    def apply_inline_style(self, r, style, bold=False, italic=False):
+        style_id = self.character_style(style)
+        if style_id is not None:
+            # Run.style looks the style up again on every assignment
+            r._r.get_or_add_rPr().style = style_id
+        # Bold and italic stay direct formatting: in a character style they
+        # would toggle the bold of heading paragraphs off instead of on
         if 'font-weight' in style:
             r.bold = (style['font-weight'] == 'bold')
-        if 'color' in style:
-            r.font.color.rgb = font_color(style['color'])
-        if 'text-decoration-line' in style and style['text-decoration-line'] == 'underline':
-            r.underline = WD_UNDERLINE.SINGLE
-        scope = [t.name for t in self.stack]
-        r.bold = r.bold or 'strong' in scope or 'b' in scope
-        r.italic = r.italic or 'em' in scope or 'i' in scope
+        r.bold = r.bold or bold
+        r.italic = r.italic or italic
 
     def apply_block_style(self, p, style):
         if 'text-align' in style:
@@ -508,15 +974,9 @@ class HtmlToDocx:
                 right={'sz': sz, 'val': 'single', 'color': color, 'space': '4'}
             )
 
-    def apply_cell_style(self, c, style):
-        if 'background-color' in style:
-            set_cell_bg_color(c, style['background-color'])
-        if 'border-top' in style:
-            sz,_,color = style['border-top'].split(' ')
-            set_cell_border(c, top={'sz': sz, 'val': 'single', 'color': color, 'space': '0'})
-        if 'border-bottom' in style:
-            sz,_,color = style['border-bottom'].split(' ')
-            set_cell_border(c, bottom={'sz': sz, 'val': 'single', 'color': color, 'space': '0'})
+    def cell_properties(self, style):
+        return cell_properties(style.get('background-color'),
+            style.get('border-top'), style.get('border-bottom'))
 
     def apply_column_style(self, c, style):
         if 'width' in style:
@@ -532,23 +992,7 @@ class HtmlToDocx:
             sz,_,color = style['border'].split(' ')
             set_image_border(i, sz, color)
 
-    def render_text(self, tag, p):
-        if not isinstance(tag, Tag):
-            r = p.add_run(tag.text)
-            self.apply_inline_style(r, get_style(tag))
-            return
-        self.stack.append(tag)
-        for t in tag:
-            self.render_text(t, p)
-        self.stack.pop()
-        return tag.text
-
-    def render_link(self, tag, p):
-        url = ''
-        if 'href' in tag.attrs:
-            url = tag['href']
-        text = tag.text
-        
+    def add_link(self, p, url, text, style, bold=False, italic=False):
         r_id = p.part.relate_to(url, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
         h = OxmlElement('w:hyperlink')
         h.set(qn('r:id'), r_id)
@@ -556,47 +1000,126 @@ class HtmlToDocx:
         r = Run(OxmlElement('w:r'), p)
         r.text = text
 
-        self.apply_inline_style(r, get_style(tag))
+        self.apply_inline_style(r, style, bold, italic)
 
         h.append(r._element)
         p._p.append(h)
 
-    def render_paragraph(self, tag, p=None):
+    def add_image(self, src, style):
+        p = self.doc.add_paragraph()
+        data = self.images.get(src)
+        image = src if data is None else io.BytesIO(data)
+        i = p.add_run().add_picture(image, width=font_size(DOC_TEXT_WIDTH))
+        self.apply_image_style(i, style)
+        return p, i
+
+    def add_table(self, rows, column_styles, style):
+        """
+        Add a table from a list of rows, each a list of (style, fill) cells
+        where fill(paragraph) renders the cell content.
+        The w:tbl element is written in one go and then filled cell by
+        cell, as python-docx's row and cell accessors rescan the whole
+        table on every call.
+        """
+        cols = len(column_styles)
+        width = Emu(self.doc._block_width / cols) if cols > 0 else Emu(0)
+        tc = '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="%d"/>%%s</w:tcPr>%%s</w:tc>' % width.twips
+        # Cell paragraphs get 5pt of spacing before and after
+        p = '<w:p><w:pPr><w:spacing w:before="100" w:after="100"/></w:pPr></w:p>'
+        xml = [TABLE_XML % (nsdecls('w'), '<w:gridCol w:w="%d"/>' % width.twips * cols)]
+        for cells in rows:
+            xml.append('<w:tr>')
+            for i in range(cols):
+                if i < len(cells):
+                    xml.append(tc % (self.cell_properties(cells[i][0]), p))
+                else:
+                    xml.append(tc % ('', '<w:p/>'))
+            xml.append('</w:tr>')
+        xml.append('</w:tbl>')
+        tbl = parse_xml(''.join(xml))
+        self.doc._body._element._insert_tbl(tbl)
+        t = Table(tbl, self.doc._body)
+        self.apply_table_style(t, style)
+
+        for tr, cells in zip(tbl.tr_lst, rows):
+            for tc, (_, fill) in zip(tr.tc_lst, cells):
+                fill(_Cell(tc, t).paragraphs[0])
+
+        for col, col_style in zip(t.columns, column_styles):
+            self.apply_column_style(col, col_style)
+
+        return t
+
+
+class HtmlToDocx(DocxWriter):
+    def __init__(self, soup: bs, template=None):
+        self.soup = soup
+        self.doc = self.setup_document(template)
+        self.contexts = {}
+
+    def context(self, tag):
+        # Style context of a tag, cascaded from its parent's on first use
+        key = id(tag)
+        if key not in self.contexts:
+            parent = ROOT_CONTEXT if tag.parent is None else self.context(tag.parent)
+            self.contexts[key] = parent.enter(tag)
+        return self.contexts[key]
+
+    def render_text(self, tag, pieces, context):
+        # Collect the text under tag for add_runs; context is the style
+        # context of tag's parent
+        if not isinstance(tag, Tag):
+            pieces.append((tag.text, context.style, context.bold, context.italic))
+            return
+        context = context.enter(tag)
+        for t in tag:
+            self.render_text(t, pieces, context)
+
+    def render_link(self, tag, p, context):
+        url = ''
+        if 'href' in tag.attrs:
+            url = tag['href']
+        context = context.enter(tag)
+        self.add_link(p, url, tag.text, context.style, context.bold, context.italic)
+
+    def render_paragraph(self, tag, p=None, children=None):
+        # children limits the paragraph to some of the tag's children
+        if children is None: children = tag.contents
         # This is a weird workaround because python-docx is bad with pictures
         if p == None:
-            if 'img' in [t.name for t in tag.children]:
-                self.render_image(tag.img)
-                p = self.doc.paragraphs[-1]
+            if 'img' in [t.name for t in children]:
+                p, _ = self.render_image(next(t for t in children if t.name == 'img'))
             else:
                 p = self.doc.add_paragraph()
-        self.apply_block_style(p, get_style(tag))
-        for t in tag:
+        context = self.context(tag)
+        self.apply_block_style(p, context.style)
+        pieces = []
+        for t in children:
             if t.name == 'img': continue
-            elif t.name == 'a': self.render_link(t, p)
-            else: self.render_text(t, p)
+            elif t.name == 'a':
+                self.add_runs(p, pieces)
+                pieces = []
+                self.render_link(t, p, context)
+            else: self.render_text(t, pieces, context)
+        self.add_runs(p, pieces)
         return p
 
     def render_table(self, tag):
-        rows, cols = table_dimensions(tag)
-        t = self.doc.add_table(rows=rows, cols=cols)
-        self.apply_table_style(t, get_style(tag))
-
-        soup_rows = tag.find_all('tr')
-        for r, row in enumerate(t.rows):
-            soup_row = soup_rows[r]
+        _, cols = table_dimensions(tag)
+        cells = []
+        # Columns are styled like the first td found in them
+        column_styles = [None] * cols
+        for soup_row in tag.find_all('tr'):
             soup_cells = soup_row.select('th,td')
-            for c, cell in enumerate(row.cells):
-                soup_cell = soup_cells[c]
-                self.render_paragraph(soup_cell, cell.paragraphs[0])
-                self.apply_cell_style(cell, get_style(soup_cell))
-                par_form = cell.paragraphs[0].paragraph_format
-                par_form.space_before = Pt(5)
-                par_form.space_after = Pt(5)
-        
-        for c, col in enumerate(t.columns):
-            soup_cell = tag.select('td:nth-child(%d)' % (c+1))[0]
-            self.apply_column_style(col, get_style(soup_cell))
-                
+            cells.append([(self.context(c).style, partial(self.render_paragraph, c))
+                for c in soup_cells])
+            for i, c in enumerate(soup_cells[:cols]):
+                if column_styles[i] is None and c.name == 'td':
+                    column_styles[i] = self.context(c).style
+        column_styles = [{} if s is None else s for s in column_styles]
+
+        t = self.add_table(cells, column_styles, self.context(tag).style)
+
         # Merge top-row cells in request/response tables
         if 'class' in tag.attrs and 'reqres' in tag['class']:
             t.cell(0, 0).merge(t.cell(0, 1))
@@ -608,34 +1131,52 @@ class HtmlToDocx:
     def render_heading(self, tag):
         level = int(tag.name[1])
         h = self.doc.add_heading('', level)
-        self.apply_block_style(h, get_style(tag))
+        self.apply_block_style(h, self.context(tag).style)
         par_form = h.paragraph_format
         par_form.line_spacing = 1.0
         par_form.space_before = Pt(16)
         par_form.space_after = Pt(4)
-        self.render_text(tag, h)
+        pieces = []
+        self.render_text(tag, pieces, self.context(tag.parent))
+        self.add_runs(h, pieces)
         return h
 
     def render_image(self, tag):
-        i = self.doc.add_picture(tag['src'], width=font_size(DOC_TEXT_WIDTH))
-        self.apply_image_style(i, get_style(tag))
-        return i
+        return self.add_image(tag['src'], self.context(tag).style)
 
     def render_code(self, tag):
         # Remove trailing newline
-        if len(tag.code.contents) > 1:
-            tag.code.contents[-1].replace_with('')
+        last = tag.code.contents[-1] if len(tag.code.contents) > 0 else None
+        if isinstance(last, NavigableString):
+            last.replace_with(last.removesuffix('\n'))
         self.render_paragraph(tag.code)
 
     def render_list(self, tag):
-        if tag.name == 'ul': style = 'List Bullet'
-        else: style = 'List Number'
-        for i in tag.select('li'):
-            self.render_paragraph(i).style = self.doc.styles[style]
+        self.list_level += 1
+        style_id, abstract_id = self.list_style(tag.name == 'ol')
+        num_id = None
+        if tag.name == 'ol':
+            num_id = self.restart_numbering(abstract_id, int(tag.get('start', 1)))
+        for item in tag.find_all('li', recursive=False):
+            # The item's paragraph is its text up to the first block, or
+            # its first paragraph; the blocks after it, nested lists
+            # included, are rendered below it
+            children = item.contents
+            i = 0
+            while i < len(children) and children[i].name not in LIST_ITEM_BLOCKS: i += 1
+            inline, blocks = children[:i], children[i:]
+            if blocks and blocks[0].name == 'p' and all(t.name is None and t.isspace() for t in inline):
+                p = self.render_paragraph(blocks[0])
+                blocks = blocks[1:]
+            else:
+                p = self.render_paragraph(item, children=inline)
+                self.strip_paragraph(p)
+            self.set_list_style(p, style_id, num_id)
+            for t in blocks:
+                if t.name is not None: self.render_tag(t)
+        self.list_level -= 1
 
     def render_tag(self, tag, level=0):
-        self.stack.append(tag)
-
         rendered = True
 
         # Parse block-level tags
@@ -659,33 +1200,1699 @@ class HtmlToDocx:
                 if t.name is None: continue
                 self.render_tag(t, level+1)
 
-        self.stack.pop()
-
     def render(self):
         self.render_tag(self.soup)
         return self.doc
 
 
-arg_parser = argparse.ArgumentParser(description='Generate a Docx file from one or more Markdown files')
-arg_parser.add_argument('output', default=None, help='Output file')
-arg_parser.add_argument('--files', default="*.md", help='Regex for Markdown files')
-args = arg_parser.parse_args()
 
-file_data = []
-for part in sorted(glob.glob(args.files)):
-    with open(part, 'r', encoding="utf-8") as f:
-        file_data.append(f.read())
+def plain_text(token):
+    if isinstance(token, span_token.LineBreak):
+        return '\n'
+    if hasattr(token, 'children') and token.children is not None:
+        return ''.join(plain_text(t) for t in token.children)
+    return getattr(token, 'content', '')
 
-html = ''.join([mistletoe.markdown(data) for data in file_data])
+def code_blocks(token):
+    for t in getattr(token, 'children', None) or []:
+        if isinstance(t, (block_token.BlockCode, block_token.CodeFence)):
+            yield t
+        elif isinstance(t, block_token.BlockToken):
+            yield from code_blocks(t)
 
-soup = bs(html, 'html.parser')
-html = soup.decode()
+def image_sources(token):
+    for t in getattr(token, 'children', None) or []:
+        if isinstance(t, span_token.Image):
+            yield t.src
+        else:
+            yield from image_sources(t)
 
-apply_html_style(soup)
+def block_name(token):
+    """
+    Name of the HTML tag a top-level block token renders to, or None if it
+    renders to none. How a block is styled depends on the one before it
+    (captions after code and tables, summary tables after h2 headings), so
+    a file rendered on its own is told the name of the block before it.
+    """
+    if isinstance(token, (block_token.Heading, block_token.SetextHeading)):
+        return 'h%d' % token.level
+    if isinstance(token, (block_token.BlockCode, block_token.CodeFence)):
+        # reqres blocks become tables
+        return 'table' if token.language == 'reqres' else 'pre'
+    if isinstance(token, block_token.List):
+        return 'ul' if token.start is None else 'ol'
+    if isinstance(token, HTMLBlock):
+        tags = bs(token.content, 'html.parser').find_all(True, recursive=False)
+        return tags[-1].name if len(tags) > 0 else None
+    return BLOCK_NAMES.get(type(token).__name__, type(token).__name__.lower())
+
+def last_block(markdown, previous=None):
+    # Tag name of the last top-level block of markdown, or previous if it
+    # has none, see block_name(). Raw HTML blocks are parsed as the
+    # renderers parse them
+    with mistletoe.HTMLRenderer():
+        blocks = mistletoe.Document(markdown).children
+    for t in reversed(blocks):
+        name = block_name(t)
+        if name is not None:
+            return name
+    return previous
+
+def soup_last_block(soup, previous=None):
+    # Tag name of the last top-level block in soup, or previous if it has none
+    tags = soup.find_all(True, recursive=False)
+    return tags[-1].name if len(tags) > 0 else previous
+
+def highlighted_runs(code_html):
+    # Split highlighted code into (text, style) pieces, where style is the
+    # combined style of the token spans around the text
+    styles = [{}]
+    for m in HIGHLIGHT_TOKEN.finditer(code_html):
+        s = m.group(0)
+        if s == '</span>':
+            styles.pop()
+        elif s.startswith('<'):
+            style = HIGHLIGHT_STYLE.search(s)
+            styles.append({**styles[-1], **style_to_dict(style.group(1) if style else '')})
+        else:
+            yield html.unescape(s), styles[-1]
 
-# For testing
-open('test.html','w').write(str(soup))
+class MarkdownToDocx(DocxWriter, BaseRenderer):
+    """
+    Renders mistletoe's token tree straight into a python-docx Document,
+    giving the same result as apply_html_style and HtmlToDocx without
+    building, styling and re-reading an HTML tree in between.
+    Raw HTML in the Markdown is ignored.
+    """
+    def __init__(self, highlight_jobs=1, highlight_cache=None, highlighter='prism', theme=None, template=None,
+            body_limit=NO_BODY_LIMIT, previous=None):
+        super().__init__(HTMLBlock, HTMLSpan)
+        self.doc = self.setup_document(template)
+        self.theme = Theme() if theme is None else theme
+        self.highlight_jobs = highlight_jobs
+        self.highlight_cache = highlight_cache
+        self.highlighter = highlighter
+        self.highlighted = {}
+        self.body_limit = body_limit
+        # (title, body) messages body_limit left out of reqres blocks
+        self.appendix = []
+        # Names of the inline tags around the current text
+        self.stack = []
+        # Paragraph and style that inline tokens are rendered into
+        self.paragraph = None
+        self.style = self.theme['text']
+        self.caption = False
+        # Tag name of the previous sibling of the block being rendered, see
+        # block_name(); previous is the block before the document
+        self.previous = previous
+
+    def emphasis(self):
+        # Bold and italic flags for the current text
+        return ('strong' in self.stack or 'b' in self.stack,
+            'em' in self.stack or 'i' in self.stack)
+
+    def highlight(self, documents):
+        blocks = []
+        for d in documents:
+            for t in code_blocks(d):
+                code = t.children[0].content
+                if t.language == 'reqres':
+                    blocks.extend((self.body_limit.shorten(val)[0], 'http') for _, _, val in reqres_rows(code))
+                elif t.language:
+                    blocks.append((code, t.language))
+        self.highlighted = prism.highlight_many(blocks, self.highlight_jobs,
+            self.highlight_cache, self.highlighter)
+
+    def code_runs(self, code, language):
+        if language:
+            return list(highlighted_runs(self.highlighted[(code, language)]))
+        return [(code, {})]
+
+    def add_text(self, text, style=None):
+        r = self.paragraph.add_run(text)
+        self.apply_inline_style(r, self.style if style is None else style, *self.emphasis())
+        return r
+
+    def add_code(self, p, runs, style):
+        bold, italic = self.emphasis()
+        self.add_runs(p, [(text, {**style, **span_style}, bold, italic)
+            for text, span_style in runs])
+
+    def render_blocks(self, tokens):
+        for t in tokens:
+            self.render(t)
+            self.previous = block_name(t) or self.previous
+
+    def render_nested(self, tokens):
+        previous = self.previous
+        self.previous = None
+        self.render_blocks(tokens)
+        self.previous = previous
+
+    def render_spans(self, tokens, p, style):
+        self.paragraph = p
+        self.style = style
+        self.render_inner(token=None, tokens=tokens)
+
+    def render_inner(self, token, tokens=None):
+        # Runs of plain text are joined into one run, like the text
+        # node they would have become in HTML
+        text = ''
+        for t in token.children if tokens is None else tokens:
+            if isinstance(t, (span_token.RawText, span_token.EscapeSequence)):
+                text += plain_text(t)
+            elif isinstance(t, span_token.LineBreak) and t.soft:
+                text += '\n'
+            else:
+                if text != '':
+                    self.add_text(text)
+                text = ''
+                if isinstance(t, span_token.LineBreak):
+                    text = '\n'
+                else:
+                    self.render(t)
+        if text != '':
+            self.add_text(text)
+        return ''
+
+    def render_document(self, token):
+        self.render_blocks(token.children)
+
+    def render_heading(self, token):
+        style = self.theme.heading(token.level)
+        h = self.doc.add_heading('', token.level)
+        self.apply_block_style(h, style)
+        par_form = h.paragraph_format
+        par_form.line_spacing = 1.0
+        par_form.space_before = Pt(16)
+        par_form.space_after = Pt(4)
+        self.render_spans(token.children, h, style)
+
+    def is_caption(self, token):
+        if self.previous in ('pre', 'table'):
+            return True
+        def has_image(t):
+            if isinstance(t, span_token.Image):
+                return True
+            return any(has_image(c) for c in getattr(t, 'children', None) or [])
+        return has_image(token)
+
+    def render_paragraph(self, token):
+        self.caption = self.is_caption(token)
+        style = self.theme['caption'] if self.caption else self.theme['text']
+        images = [t for t in token.children if isinstance(t, span_token.Image)]
+        if len(images) > 0:
+            p, _ = self.add_image(images[0].src, self.theme['image'])
+        else:
+            p = self.doc.add_paragraph()
+        self.apply_block_style(p, style)
+        self.render_spans(token.children, p, style)
+        self.caption = False
+
+    def render_strong(self, token):
+        self.stack.append('strong')
+        self.render_inner(token)
+        self.stack.pop()
+
+    def render_emphasis(self, token):
+        self.stack.append('em')
+        self.render_inner(token)
+        self.stack.pop()
+
+    def render_strikethrough(self, token):
+        self.render_inner(token)
 
-document = HtmlToDocx(soup).render()
+    def render_inline_code(self, token):
+        style = {**self.style, **self.theme['code']}
+        if self.caption:
+            style.update(self.theme['caption-code'])
+        self.add_text(token.children[0].content, style)
 
-document.save(args.output)
+    def render_link(self, token):
+        self.add_link(self.paragraph, token.target, plain_text(token), {**self.style, **self.theme['link']},
+            *self.emphasis())
+
+    def render_auto_link(self, token):
+        target = token.target
+        if token.mailto:
+            target = 'mailto:' + target
+        self.add_link(self.paragraph, target, plain_text(token), {**self.style, **self.theme['link']},
+            *self.emphasis())
+
+    def render_image(self, token):
+        # Images are placed by render_paragraph
+        pass
+
+    def render_html_span(self, token):
+        pass
+
+    def render_html_block(self, token):
+        pass
+
+    def render_thematic_break(self, token):
+        pass
+
+    def render_quote(self, token):
+        self.render_nested(token.children)
+
+    def render_block_code(self, token):
+        code = token.children[0].content
+        if token.language == 'reqres':
+            return self.render_reqres(code)
+        runs = self.code_runs(code, token.language)
+        # Remove trailing newline
+        if len(runs) > 0:
+            text, style = runs[-1]
+            runs[-1] = (text.removesuffix('\n'), style)
+        p = self.doc.add_paragraph()
+        self.apply_block_style(p, self.theme['code-block'])
+        self.add_code(p, runs, self.theme['code-block'])
+
+    def render_list(self, token):
+        self.list_level += 1
+        style_id, abstract_id = self.list_style(token.start is not None)
+        num_id = None
+        if token.start is not None:
+            num_id = self.restart_numbering(abstract_id, token.start)
+        for item in token.children:
+            p = self.doc.add_paragraph()
+            self.apply_block_style(p, self.theme['text'])
+            blocks = item.children
+            if len(blocks) > 0 and isinstance(blocks[0], block_token.Paragraph):
+                self.render_spans(blocks[0].children, p, self.theme['text'])
+                blocks = blocks[1:]
+            self.set_list_style(p, style_id, num_id)
+            self.render_nested(blocks)
+        self.list_level -= 1
+
+    def fill_cell(self, cell, style):
+        def fill(p):
+            self.apply_block_style(p, style)
+            self.render_spans(cell.children, p, style)
+        return fill
+
+    def render_table(self, token):
+        summary = self.previous == 'h2'
+        other = self.previous is not None and not summary
+        theme = self.theme
+        cell_style = {**theme['text'], **theme['cell']}
+
+        rows = []
+        header = getattr(token, 'header', None)
+        if header is not None and all(plain_text(c).strip() == '' for c in header.children):
+            header = None
+        if header is not None:
+            style = cell_style
+            if other: style = {**style, **theme['header-cell']}
+            rows.append([(style, self.fill_cell(c, style)) for c in header.children])
+
+        column_styles = None
+        for i, row in enumerate(token.children):
+            cells = []
+            for j, c in enumerate(row.children):
+                style = dict(cell_style)
+                if summary:
+                    if i == 0 and header is None: style.update(theme['summary-top'])
+                    if j == 0: style.update(theme['summary-key'])
+                    if j == 1: style.update(theme['summary-value'])
+                elif other and i % 2 == 1:
+                    style.update(theme['zebra'])
+                cells.append((style, self.fill_cell(c, style)))
+            rows.append(cells)
+            if column_styles is None:
+                column_styles = [style for style, _ in cells]
+
+        if column_styles is None:
+            column_styles = [{} for _ in rows[0]] if len(rows) > 0 else []
+        self.add_table(rows, column_styles, theme['table'])
+
+    def render_reqres(self, contents):
+        # Request/response tables are styled like other tables by the block
+        # before them, as the theme's rules do, with their own column
+        # layout on top
+        summary = self.previous == 'h2'
+        other = self.previous is not None and not summary
+        theme = self.theme
+        cell_style = {**theme['text'], **theme['cell']}
+        head_style = {**cell_style, **theme['header-cell']} if other else cell_style
+        title_style = {**head_style, **theme['reqres-header']}
+        key_style = {**cell_style, **theme['summary-key']} if summary else cell_style
+        key_style = {**key_style, **theme['reqres-key'], **theme['reqres-row']}
+        val_style = {**cell_style, **theme['summary-value']} if summary else cell_style
+        val_style = {**val_style, **theme['reqres-value'], **theme['reqres-row']}
+        even_style = {**theme['zebra'], **theme['reqres-even-row']} if other else theme['reqres-even-row']
+
+        def fill_title(p):
+            self.apply_block_style(p, title_style)
+            self.paragraph = p
+            self.stack.append('b')
+            self.add_text('Reproduction example', title_style)
+            self.stack.pop()
+
+        def fill_key(key, blurb, style):
+            def fill(p):
+                self.apply_block_style(p, style)
+                self.paragraph = p
+                self.stack.append('b')
+                self.add_text(key, style)
+                self.stack[-1] = 'i'
+                self.add_text('\n' + blurb, {**style, 'font-size': '10pt'})
+                self.stack.pop()
+            return fill
+
+        def fill_val(shown, marker, tail, style):
+            runs = self.code_runs(shown, 'http')
+            if marker != '':
+                # Themes written before reqres-omitted lack it
+                runs += [(marker, theme.styles.get('reqres-omitted', {})), (tail, {})]
+            def fill(p):
+                self.apply_block_style(p, style)
+                self.add_code(p, runs, {**style, **theme['code-block']})
+            return fill
+
+        rows = [[(title_style, fill_title), (head_style, partial(self.apply_block_style, style=head_style))]]
+        reqres = reqres_rows(contents)
+        for i, (key, blurb, val) in enumerate(reqres):
+            shown, marker, tail = self.body_limit.shorten(val)
+            k, v = key_style, val_style
+            if i % 2 == 1:
+                k, v = {**k, **even_style}, {**v, **even_style}
+            rows.append([(k, fill_key(key, blurb, k)), (v, fill_val(shown, marker, tail, v))])
+            if marker != '' and self.body_limit.appendix:
+                self.appendix.append((reqres_title(reqres, key), val))
+
+        t = self.add_table(rows, [key_style, val_style], theme['table'])
+        t.cell(0, 0).merge(t.cell(0, 1))
+
+
+class BodyStream:
+    """
+    Writes the body of doc to word/document.xml in the ZipFile z while it
+    is being rendered: flush() moves everything rendered so far out of the
+    tree and into the zip entry, so only the block being rendered is kept
+    in memory. close() ends the entry; write_package() adds the other parts.
+    """
+    def __init__(self, doc, z):
+        self.doc = doc
+        body = doc.element.body
+        sect_pr = body.sectPr
+        body.remove(sect_pr)
+        head, tail = etree.tostring(doc.element, encoding='unicode').split('<w:body/>')
+        body.append(sect_pr)
+        self.tail = '%s</w:body>%s' % (etree.tostring(sect_pr, encoding='unicode'), tail)
+        self.file = z.open('word/document.xml', 'w')
+        self.file.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n%s<w:body>' % head).encode('utf-8'))
+        # python-docx numbers drawings after the ones still in the tree
+        self.drawings = 0
+
+    def flush(self):
+        body = self.doc.element.body
+        # The sectPr stays last
+        for e in body[:-1]:
+            for d in e.iter(qn('wp:docPr')):
+                self.drawings += 1
+                d.set('id', str(self.drawings))
+                d.set('name', 'Picture %d' % self.drawings)
+            self.file.write(etree.tostring(e, encoding='utf-8'))
+            body.remove(e)
+
+    def close(self):
+        self.flush()
+        self.file.write(self.tail.encode('utf-8'))
+        self.file.close()
+
+def package_members(doc, skip_document=False):
+    # (zip member name, function returning its bytes, whether to store it
+    # uncompressed) for every part of doc's package, as python-docx saves it
+    package = doc.part.package
+    parts = list(package.iter_parts())
+    types = ''.join('<Override PartName="%s" ContentType="%s"/>' % (part.partname, part.content_type)
+        for part in parts)
+    content_types = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="%s"/><Default Extension="xml" ContentType="%s"/>'
+        '%s</Types>' % (CONTENT_TYPE.OPC_RELATIONSHIPS, CONTENT_TYPE.XML, types)).encode('utf-8')
+    yield '[Content_Types].xml', partial(bytes, content_types), False
+    yield PACKAGE_URI.rels_uri.membername, partial(getattr, package.rels, 'xml'), False
+    for part in parts:
+        if not (skip_document and part is doc.part):
+            yield part.partname.membername, partial(getattr, part, 'blob'), part.content_type in STORED_TYPES
+        if len(part.rels) > 0:
+            yield part.partname.rels_uri.membername, partial(getattr, part.rels, 'xml'), False
+
+def write_package(doc, z, compression=DEFAULT_COMPRESSION):
+    # Every part of doc's package to the ZipFile z, except the document
+    # body already written by a BodyStream
+    for name, blob, stored in package_members(doc, skip_document=True):
+        data = blob()
+        if stored or compression == 0:
+            z.writestr(name, data, zipfile.ZIP_STORED)
+        else:
+            z.writestr(name, data, zipfile.ZIP_DEFLATED, compression)
+
+def read_member(member, compression):
+    # A package member as (name, data, crc, whether to store it)
+    name, blob, stored = member
+    data = blob()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return name, data, zlib.crc32(data), stored or compression == 0
+
+def split_chunks(data):
+    # The pieces of a part deflated on their own, each with whether it is the last
+    view = memoryview(data)
+    return [(view[i:i + DEFLATE_CHUNK], i + DEFLATE_CHUNK >= len(data))
+        for i in range(0, max(len(data), 1), DEFLATE_CHUNK)]
+
+def deflate_chunk(chunk, compression):
+    # Raw deflate, as zip entries hold it. Every chunk but a part's last
+    # ends on a sync flush, so the deflated chunks join into one stream
+    data, last = chunk
+    c = zlib.compressobj(compression, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+@contextmanager
+def replacing(path):
+    """
+    Open a file next to path for writing, and move it over path once the
+    block succeeds, so a failed write leaves the previous file as it was.
+    The new file gets the previous file's mode, or the usual one for a
+    new file.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    while True:
+        tmp = os.path.join(directory, '.%s.%s.tmp' % (name, os.urandom(4).hex()))
+        try:
+            # Unlike mkstemp's 0600, 0666 is subject to the umask like open()
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            break
+        except FileExistsError:
+            pass
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        try:
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def save_document(doc, output, compression=DEFAULT_COMPRESSION, jobs=1):
+    """
+    Save doc like doc.save(output), but faster: images already
+    compressed (JPEG, PNG, GIF) are stored as they are instead of being
+    deflated again, and the other parts are serialized and deflated at
+    `compression` (0-9, 0 storing everything) over `jobs` threads, large
+    parts in DEFLATE_CHUNK pieces.
+    output is a path or a writable binary file, which need not be seekable.
+    A path is only replaced once the whole file is written.
+    """
+    members = list(package_members(doc))
+    with ExitStack() as stack:
+        map_ = map
+        if jobs > 1:
+            # zlib lets go of the GIL while it compresses
+            map_ = stack.enter_context(ThreadPoolExecutor(max_workers=jobs)).map
+        members = list(map_(partial(read_member, compression=compression), members))
+        chunks = [[] if stored else split_chunks(data) for _, data, _, stored in members]
+        deflated = iter(list(map_(partial(deflate_chunk, compression=compression),
+            [c for cs in chunks for c in cs])))
+    entries = []
+    for (name, data, crc, stored), cs in zip(members, chunks):
+        if stored:
+            entries.append((name, zipfile.ZIP_STORED, data, len(data), crc))
+        else:
+            entries.append((name, zipfile.ZIP_DEFLATED, b''.join(next(deflated) for _ in cs),
+                len(data), crc))
+    with ExitStack() as stack:
+        f = stack.enter_context(replacing(output)) if isinstance(output, (str, os.PathLike)) else output
+        offset = 0
+        directory = []
+        for name, method, data, size, crc in entries:
+            name = name.encode('utf-8')
+            if offset + len(data) > ZIP_LIMIT or size > ZIP_LIMIT:
+                raise ValueError('%s is too large for a zip file without ZIP64' % name.decode())
+            # Fixed timestamps, so the same document always gives the same file
+            header = (20, 0, method, 0, ZIP_DATE, crc, len(data), size, len(name), 0)
+            f.write(struct.pack('<4s5H3L2H', b'PK\x03\x04', *header) + name)
+            f.write(data)
+            directory.append(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, *header, 0, 0, 0, 0, offset) + name)
+            offset += 30 + len(name) + len(data)
+        directory = b''.join(directory)
+        f.write(directory)
+        f.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(entries), len(entries),
+            len(directory), offset, 0))
+
+class Profile:
+    """
+    Wall and CPU time per build stage, and counts of what was built.
+    Stage times are exclusive: a stage entered inside another one is not
+    counted in the outer one too. Times from worker processes are added
+    in, so with --jobs they are summed over the processes.
+    Set `profiler` to a cProfile.Profile to profile the render stage.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.open = []
+        self.profiler = None
+        self.start = (time.perf_counter(), time.process_time())
+
+    @contextmanager
+    def stage(self, name):
+        start = (time.perf_counter(), time.process_time())
+        self.open.append(name)
+        if name == 'render' and self.profiler is not None:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if name == 'render' and self.profiler is not None:
+                self.profiler.disable()
+            self.open.pop()
+            wall = time.perf_counter() - start[0]
+            cpu = time.process_time() - start[1]
+            self.add_time(name, wall, cpu)
+            if self.open:
+                self.add_time(self.open[-1], -wall, -cpu)
+
+    def add_time(self, name, wall, cpu):
+        times = self.stages.setdefault(name, [0.0, 0.0])
+        times[0] += wall
+        times[1] += cpu
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, other):
+        for name, (wall, cpu) in other.stages.items():
+            self.add_time(name, wall, cpu)
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def count_document(self, doc):
+        body = doc.element.body
+        self.count('paragraphs', len(body.xpath('.//w:p')))
+        self.count('runs', len(body.xpath('.//w:r')))
+        self.count('tables', len(body.xpath('.//w:tbl')))
+        self.count('images', len(body.xpath('.//w:drawing')))
+
+    def __getstate__(self):
+        # Workers send their profile back, without a profiler
+        state = dict(self.__dict__)
+        state['profiler'] = None
+        return state
+
+    def report(self):
+        # As a dict that serializes to JSON; peak RSS in bytes
+        wall = time.perf_counter() - self.start[0]
+        cpu = time.process_time() - self.start[1]
+        report = {
+            'stages': {name: {'wall': t[0], 'cpu': t[1]} for name, t in self.stages.items()},
+            'total': {'wall': wall, 'cpu': cpu},
+            'counters': dict(self.counters),
+        }
+        if resource is not None:
+            # ru_maxrss is in kB on Linux and in bytes on macOS
+            scale = 1 if sys.platform == 'darwin' else 1024
+            report['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+            report['peak_rss_children'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        return report
+
+    def format(self):
+        report = self.report()
+        lines = ['%-12s %9s %9s' % ('stage', 'wall s', 'cpu s')]
+        for name, t in report['stages'].items():
+            lines.append('%-12s %9.3f %9.3f' % (name, t['wall'], t['cpu']))
+        lines.append('%-12s %9.3f %9.3f' % ('total', report['total']['wall'], report['total']['cpu']))
+        lines.append(', '.join('%s: %d' % c for c in report['counters'].items()))
+        if 'peak_rss' in report:
+            lines.append('Peak RSS: %.1f MB (largest child process: %.1f MB)'
+                % (report['peak_rss'] / 2**20, report['peak_rss_children'] / 2**20))
+        return '\n'.join(lines)
+
+def document_template():
+    # A set-up blank document, saved so conversions can start from a copy
+    out = io.BytesIO()
+    DocxWriter().setup_document().save(out)
+    return out.getvalue()
+
+def definition_ids(doc):
+    # Ids of the styles, numbering instances and abstract numberings in doc
+    numbering = doc.part.numbering_part.element
+    return (set(doc.styles.element.xpath('w:style/@w:styleId')),
+        set(numbering.xpath('w:num/@w:numId')),
+        set(numbering.xpath('w:abstractNum/@w:abstractNumId')))
+
+class Fragment:
+    """
+    The body of a document rendered on its own, with everything it uses
+    from outside the body that is not in the base template: relationships
+    (rId -> (type, image bytes or URL, external)), styles (id -> XML) and
+    numbering (numId and abstractNumId -> XML). merge_fragments() joins
+    fragments rendered from the same template into one document.
+    """
+    def __init__(self, doc, template_ids):
+        styles, nums, abstracts = template_ids
+        body = doc.element.body
+        elements = [e for e in body if e.tag != qn('w:sectPr')]
+        self.body = ''.join([etree.tostring(e, encoding='unicode') for e in elements])
+
+        self.relationships = {}
+        for r_id in set(body.xpath('./*[not(self::w:sectPr)]//@r:*')):
+            rel = doc.part.rels[r_id]
+            if rel.is_external:
+                self.relationships[r_id] = (rel.reltype, rel.target_ref, True)
+            elif rel.reltype == RELATIONSHIP_TYPE.IMAGE:
+                self.relationships[r_id] = (rel.reltype, rel.target_part.blob, False)
+            else:
+                raise Exception('Cannot merge a %s relationship' % rel.reltype)
+
+        self.styles = {}
+        for s in doc.styles.element.xpath('w:style'):
+            if s.styleId not in styles:
+                self.styles[s.styleId] = etree.tostring(s, encoding='unicode')
+
+        # Image files it embeds -> their file_stamp(), the messages left out
+        # of its reqres blocks for the appendix, see Converter.fragment(), and
+        # the tag name of its last block (of the one before if it has none)
+        self.images = {}
+        self.appendix = []
+        self.last = None
+
+        self.nums = {}
+        self.abstract_nums = {}
+        numbering = doc.part.numbering_part.element
+        # In the order they were added, so merged lists keep that order of ids
+        for num_id in sorted(set(body.xpath('.//w:numPr/w:numId/@w:val')) - nums, key=int):
+            num = numbering.num_having_numId(int(num_id))
+            self.nums[num_id] = etree.tostring(num, encoding='unicode')
+            abstract_id = num.abstractNumId.val
+            if str(abstract_id) not in abstracts:
+                abstract = numbering.xpath('w:abstractNum[@w:abstractNumId="%d"]' % abstract_id)[0]
+                self.abstract_nums[str(abstract_id)] = etree.tostring(abstract, encoding='unicode')
+
+    def dumps(self):
+        # As JSON bytes for the fragment cache, image bytes in base64
+        relationships = {r_id: (reltype, target if external else base64.b64encode(target).decode(), external)
+            for r_id, (reltype, target, external) in self.relationships.items()}
+        return json.dumps(dict(body=self.body, relationships=relationships, styles=self.styles,
+            nums=self.nums, abstract_nums=self.abstract_nums, images=self.images,
+            appendix=self.appendix, last=self.last)).encode('utf-8')
+
+    @classmethod
+    def loads(cls, data):
+        # The fragment dumps() returned the bytes of; raises ValueError for
+        # anything else
+        try:
+            d = json.loads(data)
+            fragment = cls.__new__(cls)
+            fragment.body = d['body']
+            fragment.relationships = {r_id: (reltype, target if external else base64.b64decode(target), external)
+                for r_id, (reltype, target, external) in d['relationships'].items()}
+            fragment.styles = d['styles']
+            fragment.nums = d['nums']
+            fragment.abstract_nums = d['abstract_nums']
+            fragment.images = {src: None if stamp is None else tuple(stamp) for src, stamp in d['images'].items()}
+            fragment.appendix = [(title, body) for title, body in d['appendix']]
+            fragment.last = d['last']
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError('Not a cached fragment: %s' % e)
+        return fragment
+
+def file_stamp(path):
+    # Changes whenever the file does, None for a missing file or a URL
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def next_id(ids):
+    return max([int(i) for i in ids], default=0) + 1
+
+def add_fragment(doc, fragment):
+    # Add the definitions of fragment to doc under new ids where needed,
+    # then its body with the references rewritten
+    part = doc.part
+    styles = doc.styles.element
+    for style_id, xml in fragment.styles.items():
+        # Styles added by the renderers are named after their formatting,
+        # so the same id always means the same definition
+        if styles.get_by_id(style_id) is None:
+            styles.append(parse_xml(xml))
+
+    r_ids = {}
+    for r_id, (reltype, target, external) in fragment.relationships.items():
+        if not external:
+            target = part.package.get_or_add_image_part(io.BytesIO(target))
+        r_ids[r_id] = part.relate_to(target, reltype, is_external=external)
+
+    num_ids = {}
+    if fragment.nums:
+        numbering = part.numbering_part.element
+        abstract_ids = {}
+        new_id = next_id(numbering.xpath('w:abstractNum/@w:abstractNumId'))
+        for abstract_id, xml in fragment.abstract_nums.items():
+            abstract = parse_xml(xml)
+            abstract.set(qn('w:abstractNumId'), str(new_id))
+            abstract_ids[abstract_id] = new_id
+            # w:abstractNum elements must all come before the w:num ones
+            nums = numbering.num_lst
+            if nums: nums[0].addprevious(abstract)
+            else: numbering.append(abstract)
+            new_id += 1
+        new_id = next_id(numbering.xpath('w:num/@w:numId'))
+        for num_id, xml in fragment.nums.items():
+            num = parse_xml(xml)
+            num.numId = new_id
+            abstract_id = str(num.abstractNumId.val)
+            if abstract_id in abstract_ids:
+                num.abstractNumId.val = abstract_ids[abstract_id]
+            numbering.append(num)
+            num_ids[num_id] = new_id
+            new_id += 1
+
+    body = parse_xml('<w:body %s>%s</w:body>' % (nsdecls('w'), fragment.body))
+    for attr in body.xpath('.//@r:*'):
+        if attr in r_ids:
+            attr.getparent().set(attr.attrname, r_ids[attr])
+    for e in body.xpath('.//w:numPr/w:numId'):
+        if str(e.val) in num_ids:
+            e.val = num_ids[str(e.val)]
+    sect_pr = doc.element.body.sectPr
+    for e in list(body):
+        sect_pr.addprevious(e)
+
+def merge_fragments(template, fragments):
+    """
+    Build one document from the base template and fragments rendered from
+    it, in order.
+    """
+    doc = Document(io.BytesIO(template))
+    for fragment in fragments:
+        add_fragment(doc, fragment)
+    # Drawing ids must be unique in the document
+    for i, e in enumerate(doc.element.body.iter(qn('wp:docPr')), 1):
+        e.set('id', str(i))
+        # Named after their id, like python-docx names them
+        e.set('name', 'Picture %d' % i)
+    return doc
+
+class ImagePathError(ValueError):
+    """An image source outside Converter.image_root."""
+
+class Converter:
+    """
+    Converts Markdown to Docx, keeping what is expensive to set up between
+    conversions: the compiled theme, the highlighter and its workers, the
+    caches and the blank base document. Close it when done (or use it as
+    a context manager) to stop the highlighter workers, once no other
+    Converter uses them.
+
+    cache_dir=None turns the highlight and image caches off. body_limit, a
+    BodyLimit, shortens long messages in reqres blocks. Set image_root to
+    a directory to refuse images outside it with an ImagePathError.
+    """
+    def __init__(self, renderer='markdown', theme=DEFAULT_THEME, highlighter='prism',
+            highlight_jobs=DEFAULT_JOBS, cache_dir=prism.cache.DEFAULT_CACHE_DIR,
+            cache_size=prism.cache.DEFAULT_MAX_SIZE, image_dpi=DEFAULT_IMAGE_DPI,
+            jpeg_quality=DEFAULT_JPEG_QUALITY, image_jobs=DEFAULT_JOBS, jobs=1,
+            compression=DEFAULT_COMPRESSION, body_limit=None):
+        # Time spent per stage and counts, see Profile
+        self.profile = Profile()
+        if renderer not in ('markdown', 'html'):
+            raise Exception('Unknown renderer: %s' % renderer)
+        self.renderer = renderer
+        self.theme = theme if isinstance(theme, Theme) else Theme(theme)
+        self.highlighter = highlighter
+        self.highlight_jobs = highlight_jobs
+        self.image_dpi = image_dpi
+        self.jpeg_quality = jpeg_quality
+        self.image_jobs = image_jobs
+        self.compression = compression
+        self.body_limit = NO_BODY_LIMIT if body_limit is None else body_limit
+        # Processes rendering files in parallel, see render()
+        self.jobs = jobs
+        self.pool = None
+        # Options for the Converters of the worker processes, which
+        # already run in parallel
+        self.options = dict(renderer=renderer, theme=theme, highlighter=highlighter,
+            highlight_jobs=1, cache_dir=cache_dir, cache_size=cache_size,
+            image_dpi=image_dpi, jpeg_quality=jpeg_quality, image_jobs=1,
+            compression=compression, body_limit=body_limit)
+        self.highlight_cache = None
+        self.image_cache = None
+        self.fragment_cache = None
+        if cache_dir is not None:
+            self.highlight_cache = prism.HighlightCache(cache_dir, cache_size)
+            self.image_cache = prism.cache.FileCache(cache_dir, 'image', cache_size)
+            self.fragment_cache = prism.cache.FileCache(cache_dir, 'fragment', cache_size, '.json')
+        # Directory the image sources must resolve inside, or None
+        self.image_root = None
+        # Indexes of the Markdown strings rendered by the last render(),
+        # and the image sources it embeds
+        self.rebuilt = []
+        self.image_files = []
+
+        # Everything besides the Markdown and its images that a fragment
+        # depends on
+        h = hashlib.sha256()
+        h.update(prism.cache.file_digest(__file__).encode())
+        # The prism package parses the theme and highlights with Pygments
+        for path in sorted(glob.glob(os.path.join(prism.file_path, '*.py'))):
+            h.update(prism.cache.file_digest(path).encode())
+        h.update(self.theme.digest.encode())
+        h.update(prism.cache.file_digest(os.path.join(prism.file_path, 'prism.css')).encode())
+        # Shared with other Converters in the process, see close()
+        h.update(prism.acquire(highlighter).version.encode())
+        self.closed = False
+        h.update(('%s %s %d %d %r\0' % (renderer, PIL.__version__, image_dpi, jpeg_quality,
+            self.body_limit)).encode())
+        self.fingerprint = h.digest()
+        self.template = document_template()
+        self.template_ids = definition_ids(Document(io.BytesIO(self.template)))
+        start = self.profile.start
+        self.profile.add_time('setup', time.perf_counter() - start[0], time.process_time() - start[1])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def check_images(self, srcs):
+        if self.image_root is None:
+            return
+        root = os.path.join(os.path.realpath(self.image_root), '')
+        for src in srcs:
+            if not os.path.realpath(src).startswith(root):
+                raise ImagePathError('Image outside %s: %s' % (self.image_root, src))
+
+    def load_images(self, srcs):
+        self.check_images(srcs)
+        return load_images(srcs, self.image_dpi, self.jpeg_quality, self.image_jobs, self.image_cache)
+
+    def render(self, markdown_sources):
+        """
+        Render one Markdown string, or a list of them rendered one after
+        the other, to a python-docx Document.
+        With jobs > 1, each string is rendered to a Fragment in a pool of
+        worker processes and the fragments are merged in order. With the
+        caches on, the fragment of each string is cached too and only the
+        strings that changed are rendered again; self.rebuilt lists their
+        indexes.
+        """
+        if isinstance(markdown_sources, str):
+            markdown_sources = [markdown_sources]
+        if self.fragment_cache is None and (self.jobs <= 1 or len(markdown_sources) <= 1):
+            self.rebuilt = list(range(len(markdown_sources)))
+            doc, self.image_files, _ = self.render_document(markdown_sources)
+            self.trim()
+            return doc
+        if self.fragment_cache is not None:
+            fragments = self.cached_fragments(markdown_sources)
+        else:
+            self.rebuilt = list(range(len(markdown_sources)))
+            # Each string is rendered knowing the last block of the one before
+            previous = [None]
+            with self.profile.stage('parse'):
+                for markdown in markdown_sources:
+                    previous.append(last_block(markdown, previous[-1]))
+            fragments = self.render_fragments(markdown_sources, previous[:-1])
+            for fragment, last in zip(fragments, previous[1:]):
+                fragment.last = last
+        self.image_files = [src for fragment in fragments for src in fragment.images]
+        appendix = [body for fragment in fragments for body in fragment.appendix]
+        if len(appendix) > 0:
+            fragments.append(self.fragment(appendix_markdown(appendix), fragments[-1].last))
+        with self.profile.stage('merge'):
+            doc = merge_fragments(self.template, fragments)
+        self.trim()
+        return doc
+
+    def fragment_key(self, markdown, previous):
+        h = hashlib.sha256(self.fingerprint)
+        h.update(('%s\0' % previous).encode())
+        h.update(markdown.encode('utf-8'))
+        return h.hexdigest()
+
+    def cached_fragment(self, key):
+        data = self.fragment_cache.read(key)
+        if data is None:
+            return None
+        try:
+            fragment = Fragment.loads(data)
+        except ValueError:
+            # Written by an older version, or damaged
+            fragment = None
+        # The images it embeds may have changed since
+        if fragment is None or any(file_stamp(src) != stamp for src, stamp in fragment.images.items()):
+            self.fragment_cache.count(hits=-1, misses=1)
+            return None
+        # Cached by a build that allowed other images
+        self.check_images(fragment.images)
+        return fragment
+
+    def cached_fragments(self, markdown_sources):
+        # A fragment is styled according to the last block of the one
+        # before, so it is keyed on that too
+        keys = []
+        fragments = []
+        previous = [None]
+        with self.profile.stage('cache'):
+            for markdown in markdown_sources:
+                keys.append(self.fragment_key(markdown, previous[-1]))
+                fragment = self.cached_fragment(keys[-1])
+                fragments.append(fragment)
+                if fragment is not None:
+                    previous.append(fragment.last)
+                    continue
+                with self.profile.stage('parse'):
+                    previous.append(last_block(markdown, previous[-1]))
+        self.rebuilt = [i for i, fragment in enumerate(fragments) if fragment is None]
+        rendered = self.render_fragments([markdown_sources[i] for i in self.rebuilt],
+            [previous[i] for i in self.rebuilt])
+        with self.profile.stage('cache'):
+            for i, fragment in zip(self.rebuilt, rendered):
+                fragment.last = previous[i + 1]
+                fragments[i] = fragment
+                self.fragment_cache.write(keys[i], fragment.dumps())
+        return fragments
+
+    def render_fragments(self, markdown_sources, previous):
+        # previous holds the tag name of the block before each string
+        if self.jobs <= 1 or len(markdown_sources) <= 1:
+            return [self.fragment(markdown, p) for markdown, p in zip(markdown_sources, previous)]
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.jobs, initializer=worker_init,
+                initargs=(self.options, os.getcwd()))
+        caches = [self.highlight_cache, self.image_cache]
+        fragments = []
+        for fragment, stats, profile in self.pool.map(worker_fragment, markdown_sources, previous):
+            fragments.append(fragment)
+            # Count the workers' cache use and time in the reports
+            for cache, (hits, misses) in zip(caches, stats):
+                if cache is not None:
+                    cache.count(hits, misses)
+            self.profile.add(profile)
+        return fragments
+
+    def fragment(self, markdown, previous=None):
+        # Its appendix is left to render(), to come after every fragment
+        doc, srcs, appendix = self.render_document([markdown], appendix=False, previous=previous)
+        with self.profile.stage('fragment'):
+            fragment = Fragment(doc, self.template_ids)
+        fragment.images = {src: file_stamp(src) for src in srcs}
+        fragment.appendix = appendix
+        return fragment
+
+    def render_document(self, markdown_sources, appendix=True, previous=None):
+        """
+        Render markdown_sources into a new document, styled as if it came
+        after a block with the tag name previous. Returns it, the image
+        sources it embeds and the (title, body) messages left out of its
+        reqres blocks, which with appendix are already rendered at its end.
+        """
+        profile = self.profile
+        h = prism.get_highlighter(self.highlighter)
+        calls = h.calls
+        if self.renderer == 'html':
+            renderer = HtmlToDocx(None, self.template)
+            srcs, bodies, last = self.render_html(renderer, markdown_sources, previous)
+            if appendix and len(bodies) > 0:
+                self.render_html(renderer, [appendix_markdown(bodies)], last)
+            doc = renderer.doc
+        else:
+            with MarkdownToDocx(self.highlight_jobs, self.highlight_cache, self.highlighter,
+                    self.theme, self.template, self.body_limit, previous) as renderer:
+                srcs = self.render_markdown(renderer, markdown_sources)
+                bodies = renderer.appendix
+                if appendix and len(bodies) > 0:
+                    self.render_markdown(renderer, [appendix_markdown(bodies)])
+                doc = renderer.doc
+        profile.count('highlighter calls', h.calls - calls)
+        return doc, srcs, bodies
+
+    def render_html(self, renderer, markdown_sources, previous=None):
+        # Render into the HtmlToDocx renderer; returns the image sources, the
+        # messages left out of reqres blocks and the tag name of the last block
+        profile = self.profile
+        with profile.stage('markdown'):
+            html = ''.join([mistletoe.markdown(data) for data in markdown_sources])
+        with profile.stage('parse'):
+            soup = bs(html, 'html.parser')
+        profile.count('code blocks', len(soup.select('pre > code')))
+        with profile.stage('style'):
+            bodies = apply_html_style(soup, self.highlight_jobs, self.highlight_cache,
+                self.highlighter, self.theme, profile, self.body_limit, previous)
+        srcs = [t['src'] for t in soup.find_all('img')]
+        with profile.stage('images'):
+            renderer.images = self.load_images(srcs)
+        renderer.soup = soup
+        # Contexts are memoized by id(), which tags of an earlier soup may share
+        renderer.contexts = {}
+        with profile.stage('render'):
+            renderer.render()
+        return srcs, bodies, soup_last_block(soup, previous)
+
+    def render_markdown(self, renderer, markdown_sources):
+        # Render into the MarkdownToDocx renderer; returns the image sources
+        profile = self.profile
+        with profile.stage('parse'):
+            documents = [mistletoe.Document(data) for data in markdown_sources]
+        profile.count('code blocks', sum(1 for d in documents for _ in code_blocks(d)))
+        with profile.stage('highlight'):
+            renderer.highlight(documents)
+        srcs = [src for d in documents for src in image_sources(d)]
+        with profile.stage('images'):
+            renderer.images = self.load_images(srcs)
+        with profile.stage('render'):
+            for d in documents:
+                renderer.render(d)
+        return srcs
+
+    def convert(self, markdown_sources, output):
+        """
+        Render markdown_sources like render() and save the result to
+        output, a path or a writable binary file.
+        """
+        document = self.render(markdown_sources)
+        with self.profile.stage('save'):
+            # The image threads are free by now
+            save_document(document, output, self.compression, self.image_jobs)
+        return document
+
+    def stream(self, markdown_sources, output):
+        """
+        Convert like convert(), with memory use that stays flat however
+        large the report: markdown_sources may be any iterable, e.g. a
+        generator reading the files one by one, and each string is parsed,
+        styled and rendered on its own. Every top-level block is written to
+        output as soon as it is rendered and then dropped. Only images,
+        style definitions and messages for the appendix are kept until the end.
+        Always renders serially and without the fragment cache.
+        """
+        profile = self.profile
+        h = prism.get_highlighter(self.highlighter)
+        calls = h.calls
+        self.rebuilt = []
+        self.image_files = []
+        method = zipfile.ZIP_STORED if self.compression == 0 else zipfile.ZIP_DEFLATED
+        with ExitStack() as stack:
+            if isinstance(output, (str, os.PathLike)):
+                # A failed build keeps the previous output, like save_document()
+                output = stack.enter_context(replacing(output))
+            z = stack.enter_context(zipfile.ZipFile(output, 'w', method, compresslevel=self.compression))
+            if self.renderer == 'html':
+                renderer = HtmlToDocx(None, self.template)
+            else:
+                renderer = stack.enter_context(MarkdownToDocx(self.highlight_jobs,
+                    self.highlight_cache, self.highlighter, self.theme, self.template,
+                    self.body_limit))
+            body = BodyStream(renderer.doc, z)
+            # On errors too, or closing z would fail over the open entry
+            stack.callback(body.file.close)
+            bodies = [] if self.renderer == 'html' else renderer.appendix
+            # Tag name of the last block so far, for the HTML renderer
+            previous = None
+            # None stands for the appendix, after the sources
+            for i, markdown in enumerate(chain(markdown_sources, [None])):
+                if markdown is None:
+                    if len(bodies) == 0:
+                        break
+                    markdown = appendix_markdown(bodies)
+                else:
+                    self.rebuilt.append(i)
+                if self.renderer == 'html':
+                    with profile.stage('markdown'):
+                        html = mistletoe.markdown(markdown)
+                    with profile.stage('parse'):
+                        soup = bs(html, 'html.parser')
+                    del html
+                    profile.count('code blocks', len(soup.select('pre > code')))
+                    with profile.stage('style'):
+                        bodies.extend(apply_html_style(soup, self.highlight_jobs, self.highlight_cache,
+                            self.highlighter, self.theme, profile, self.body_limit, previous))
+                    previous = soup_last_block(soup, previous)
+                    srcs = [t['src'] for t in soup.find_all('img')]
+                    with profile.stage('images'):
+                        renderer.images = self.load_images(srcs)
+                    renderer.soup = soup
+                    for t in list(soup.contents):
+                        if t.name is None: continue
+                        with profile.stage('render'):
+                            renderer.render_tag(t, 1)
+                        t.decompose()
+                        # Contexts are memoized by id(), which freed tags give up
+                        renderer.contexts = {}
+                        with profile.stage('write'):
+                            body.flush()
+                else:
+                    with profile.stage('parse'):
+                        d = mistletoe.Document(markdown)
+                    profile.count('code blocks', sum(1 for _ in code_blocks(d)))
+                    with profile.stage('highlight'):
+                        renderer.highlight([d])
+                    srcs = list(image_sources(d))
+                    with profile.stage('images'):
+                        renderer.images = self.load_images(srcs)
+                    blocks = d.children
+                    del d
+                    for j in range(len(blocks)):
+                        with profile.stage('render'):
+                            renderer.render_blocks([blocks[j]])
+                        blocks[j] = None
+                        with profile.stage('write'):
+                            body.flush()
+                self.image_files.extend(srcs)
+            with profile.stage('write'):
+                body.close()
+            with profile.stage('save'):
+                write_package(renderer.doc, z, self.compression)
+        profile.count('highlighter calls', h.calls - calls)
+        self.trim()
+
+    def trim(self):
+        # Once per build rather than per file, as each trim walks the
+        # whole cache directory
+        with self.profile.stage('cache'):
+            for cache in (self.highlight_cache, self.image_cache, self.fragment_cache):
+                if cache is not None:
+                    cache.trim()
+
+    def warm(self):
+        # Start the highlighter now rather than on the first code block
+        prism.highlight('', 'markup', self.highlighter)
+
+    def reports(self):
+        caches = (self.highlight_cache, self.image_cache, self.fragment_cache)
+        return [c.report() for c in caches if c is not None]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        # Other Converters may still use the highlighter
+        if not self.closed:
+            self.closed = True
+            prism.release(self.highlighter)
+
+def convert(markdown_sources, output, **options):
+    """
+    Convert Markdown to a Docx file in one go. Takes the options of
+    Converter; use a Converter directly to convert several documents.
+    """
+    with Converter(**options) as converter:
+        return converter.convert(markdown_sources, output)
+
+
+def find_sources(patterns):
+    # The Markdown files matching each glob in patterns, each glob sorted
+    return [part for pattern in patterns for part in sorted(glob.glob(pattern))]
+
+def read_sources(paths):
+    sources = []
+    for part in paths:
+        with open(part, 'r', encoding="utf-8") as f:
+            sources.append(f.read())
+    return sources
+
+def iter_sources(paths):
+    # Like read_sources, one file at a time
+    for part in paths:
+        with open(part, 'r', encoding="utf-8") as f:
+            yield f.read()
+
+def load_manifest(path):
+    """
+    Read a batch manifest: a JSON list of {"files": <glob or list of
+    globs>, "output": <path>} jobs. Returns a list of (globs, output) pairs.
+    """
+    with open(path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    jobs = []
+    for job in manifest:
+        files = job['files']
+        if isinstance(files, str):
+            files = [files]
+        jobs.append((files, job['output']))
+    return jobs
+
+# The Converter of a worker process, see worker_init()
+worker_converter = None
+
+def worker_init(options, directory):
+    global worker_converter
+    # Paths in the jobs, and image paths in the Markdown, are relative to this
+    os.chdir(directory)
+    worker_converter = Converter(**options)
+    worker_converter.warm()
+
+def worker_fragment(markdown, previous):
+    # Runs in a worker process; also returns the cache hits and misses and
+    # the Profile of the rendering
+    caches = [worker_converter.highlight_cache, worker_converter.image_cache]
+    before = [(c.hits, c.misses) if c is not None else (0, 0) for c in caches]
+    worker_converter.profile = Profile()
+    fragment = worker_converter.fragment(markdown, previous)
+    after = [(c.hits, c.misses) if c is not None else (0, 0) for c in caches]
+    return (fragment, [(a[0] - b[0], a[1] - b[1]) for a, b in zip(after, before)],
+        worker_converter.profile)
+
+def batch_job(files, output):
+    # Runs in a worker process; failures are returned, not raised
+    start = time.perf_counter()
+    try:
+        sources = read_sources(find_sources(files))
+        if len(sources) == 0:
+            raise Exception('No Markdown files match %s' % ', '.join(files))
+        worker_converter.convert(sources, output)
+    except Exception as e:
+        return time.perf_counter() - start, '%s: %s' % (type(e).__name__, e)
+    return time.perf_counter() - start, None
+
+def run_batch(jobs, options, workers=None, directory='.'):
+    """
+    Convert (globs, output) jobs in parallel over a pool of `workers`
+    processes (default: one per core), each with its own Converter built
+    from `options` and working in `directory`. A failed job does not stop
+    the others. Prints a line per job as it finishes and returns the
+    number of failed jobs.
+    """
+    start = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=worker_init,
+            initargs=(options, directory)) as executor:
+        futures = {executor.submit(batch_job, *job): job for job in jobs}
+        for future in as_completed(futures):
+            _, output = futures[future]
+            try:
+                elapsed, error = future.result()
+            except Exception as e:
+                # The worker process itself died
+                elapsed, error = 0.0, '%s: %s' % (type(e).__name__, e)
+            if error is None:
+                print('ok     %7.2fs  %s' % (elapsed, output))
+            else:
+                failed += 1
+                print('FAILED %7.2fs  %s: %s' % (elapsed, output, error))
+    print('%d jobs, %d failed, %.2fs' % (len(jobs), failed, time.perf_counter() - start))
+    return failed
+
+def serve_job(markdown_sources, directory):
+    # Runs in a worker process; image paths in the Markdown are relative
+    # to directory, which holds the uploaded assets, and may not leave it
+    start = os.getcwd()
+    output = io.BytesIO()
+    try:
+        os.chdir(directory)
+        worker_converter.image_root = directory
+        worker_converter.convert(markdown_sources, output)
+    finally:
+        worker_converter.image_root = None
+        os.chdir(start)
+    return output.getvalue()
+
+def worker_ready():
+    return os.getpid()
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class ConversionService:
+    """
+    The worker pool behind --serve: a pool of `workers` processes, each
+    with a warm Converter built from `options`, and a queue bounded to
+    `queue_size` conversions waiting for a worker. submit() refuses work
+    beyond that rather than queueing it, and gives up on a conversion
+    after `timeout` seconds.
+    """
+    def __init__(self, options, workers=DEFAULT_JOBS, queue_size=None, timeout=SERVE_TIMEOUT):
+        self.workers = workers
+        self.queue_size = 2 * workers if queue_size is None else queue_size
+        self.timeout = timeout
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=worker_init,
+            initargs=(options, os.getcwd()))
+        self.slots = threading.BoundedSemaphore(workers + self.queue_size)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.latencies = deque(maxlen=SERVE_LATENCIES)
+        self.counters = dict(ok=0, failed=0, rejected=0, timed_out=0)
+        self.start = time.time()
+
+    def warm(self):
+        # Start every worker, and its highlighter, before the first request
+        for f in [self.pool.submit(worker_ready) for _ in range(self.workers)]:
+            f.result()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def done(self, directory, future):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def submit(self, markdown_sources, directory):
+        """
+        Convert markdown_sources in a worker and return the Docx bytes.
+        Returns None when the queue is full. directory holds the assets,
+        the only images the conversion may embed, and is removed once it
+        is over.
+        Raises TimeoutError when it takes longer than the timeout, and
+        ImagePathError for an image outside directory.
+        """
+        if not self.slots.acquire(blocking=False):
+            self.count('rejected')
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        start = time.perf_counter()
+        with self.lock:
+            self.pending += 1
+        future = self.pool.submit(serve_job, markdown_sources, directory)
+        # The slot stays taken until the worker is done, even after a timeout
+        future.add_done_callback(partial(self.done, directory))
+        try:
+            data = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self.count('timed_out')
+            raise TimeoutError('Conversion took longer than %ss' % self.timeout)
+        except Exception:
+            self.count('failed')
+            raise
+        with self.lock:
+            self.counters['ok'] += 1
+            self.latencies.append(time.perf_counter() - start)
+        return data
+
+    def metrics(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            pending = self.pending
+            counters = dict(self.counters)
+        return dict(requests=counters, workers=self.workers,
+            busy=min(pending, self.workers), queue_depth=max(0, pending - self.workers),
+            queue_size=self.queue_size, uptime=time.time() - self.start,
+            latency={'p%d' % p: percentile(latencies, p) for p in (50, 90, 99)})
+
+    def close(self):
+        # Conversions that timed out may still be running; stop them rather
+        # than wait
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        for p in multiprocessing.active_children():
+            p.terminate()
+
+class ServeHandler(BaseHTTPRequestHandler):
+    """
+    POST /convert takes a Markdown document (any content type), or a zip
+    archive of Markdown files and the images they embed (application/zip)
+    whose files matching ?files= (default: *.md) are converted in order;
+    and answers with the Docx. GET /metrics reports the request counts,
+    queue depth and latency percentiles as JSON.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def reply(self, status, body, content_type='text/plain; charset=utf-8', headers=()):
+        if isinstance(body, str):
+            body = (body + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/metrics':
+            return self.reply(404, 'Not found')
+        self.reply(200, json.dumps(self.server.service.metrics(), indent=2), 'application/json')
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/convert':
+            return self.reply(404, 'Not found')
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return self.reply(411, 'Content-Length required')
+        if not length.isdigit():
+            # The body cannot be skipped without its length
+            self.close_connection = True
+            return self.reply(400, 'Invalid Content-Length: %s' % length)
+        data = self.rfile.read(int(length))
+        # Conversions run from here, so a plain Markdown document finds no
+        # images on the server either
+        directory = tempfile.mkdtemp(prefix='md2docx-')
+        try:
+            if self.headers.get_content_type() == 'application/zip':
+                pattern = parse_qs(url.query).get('files', ['*.md'])[0]
+                if os.path.isabs(pattern) or '..' in pattern.replace('\\', '/').split('/'):
+                    raise ValueError('?files= must be relative to the archive: %s' % pattern)
+                with zipfile.ZipFile(io.BytesIO(data)) as z:
+                    z.extractall(directory)
+                root = os.path.join(os.path.realpath(directory), '')
+                paths = sorted(path for path in glob.glob(os.path.join(directory, pattern))
+                               if os.path.realpath(path).startswith(root))
+                if len(paths) == 0:
+                    raise ValueError('No Markdown files match %s' % pattern)
+                sources = read_sources(paths)
+            else:
+                sources = [data.decode('utf-8')]
+        except (ValueError, zipfile.BadZipFile) as e:
+            shutil.rmtree(directory, ignore_errors=True)
+            return self.reply(400, '%s: %s' % (type(e).__name__, e))
+        try:
+            docx = self.server.service.submit(sources, directory)
+        except TimeoutError as e:
+            return self.reply(504, str(e))
+        except ImagePathError as e:
+            return self.reply(400, '%s: %s' % (type(e).__name__, e))
+        except Exception as e:
+            return self.reply(500, '%s: %s' % (type(e).__name__, e))
+        if docx is None:
+            return self.reply(503, 'Queue full', headers=[('Retry-After', '1')])
+        self.reply(200, docx, DOCX_TYPE)
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def is_stale_socket(address):
+    # Whether a Unix socket may be created at address, replacing what is there
+    try:
+        return stat.S_ISSOCK(os.stat(address).st_mode)
+    except FileNotFoundError:
+        return True
+
+def serve(service, address):
+    """
+    Serve ServeHandler's endpoints on address, either host:port or the
+    path of a Unix socket, until interrupted.
+    """
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), ServeHandler)
+    else:
+        # Only a stale socket is replaced, never a file given by mistake
+        if not is_stale_socket(address):
+            raise FileExistsError('%s exists and is not a socket' % address)
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixHTTPServer(address, ServeHandler)
+    server.service = service
+    print('Serving on %s with %d workers' % (address, service.workers))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if ':' not in address:
+            os.remove(address)
+
+def watch(converter, patterns, output, interval=WATCH_INTERVAL):
+    """
+    Build output from the Markdown files matching patterns, then rebuild
+    it whenever one of them, or an image they embed, changes; until
+    interrupted. Files are polled every `interval` seconds, and a rebuild
+    waits until nothing has changed for one interval, so a burst of saves
+    only triggers one.
+    """
+    def snapshot(paths):
+        return {path: file_stamp(path) for path in paths}
+
+    def current():
+        return snapshot(find_sources(patterns) + converter.image_files)
+
+    def build():
+        start = time.perf_counter()
+        paths = find_sources(patterns)
+        # Taken before building, so that saves during the build trigger another
+        before = snapshot(paths + converter.image_files)
+        try:
+            converter.convert(read_sources(paths), output)
+        except Exception as e:
+            print('Failed to build %s: %s: %s' % (output, type(e).__name__, e))
+        else:
+            print('Built %s in %.2fs, rebuilt %d of %d files' % (output,
+                time.perf_counter() - start, len(converter.rebuilt), len(paths)))
+            for i in converter.rebuilt:
+                print('  %s' % paths[i])
+        stamps = {path: before[path] for path in paths}
+        for src in converter.image_files:
+            stamps[src] = before[src] if src in before else file_stamp(src)
+        return stamps
+
+    stamps = build()
+    while True:
+        time.sleep(interval)
+        changed = current()
+        if changed == stamps:
+            continue
+        while True:
+            time.sleep(interval)
+            latest = current()
+            if latest == changed:
+                break
+            changed = latest
+        stamps = build()
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Generate a Docx file from one or more Markdown files')
+    arg_parser.add_argument('output', nargs='?', default=None, help='Output file, - for stdout')
+    arg_parser.add_argument('--files', default="*.md", help='Regex for Markdown files')
+    arg_parser.add_argument('--jobs', type=int, default=1, help='Number of processes rendering the Markdown files in parallel')
+    arg_parser.add_argument('--batch', metavar='MANIFEST', help='Convert the jobs listed in a JSON manifest in parallel instead')
+    arg_parser.add_argument('--watch', action='store_true', help='Rebuild the output whenever the Markdown files or their images change')
+    arg_parser.add_argument('--stream', action='store_true', help='Write the output while rendering, one block at a time, to keep memory use flat')
+    arg_parser.add_argument('--batch-jobs', type=int, default=None, help='Number of batch worker processes (default: one per core)')
+    arg_parser.add_argument('--serve', metavar='ADDRESS', help='Serve conversions over HTTP on host:port or a Unix socket path instead')
+    arg_parser.add_argument('--serve-jobs', type=int, default=DEFAULT_JOBS, help='Number of --serve worker processes (default: up to 4)')
+    arg_parser.add_argument('--queue-size', type=int, default=None, help='Conversions --serve queues before refusing more (default: twice --serve-jobs)')
+    arg_parser.add_argument('--timeout', type=float, default=SERVE_TIMEOUT, help='Seconds a --serve conversion may take, queueing included')
+    arg_parser.add_argument('--renderer', default='markdown', choices=['markdown', 'html'], help='Render the Markdown directly, or through styled HTML (slower)')
+    arg_parser.add_argument('--highlight-jobs', type=int, default=None, help='Number of parallel syntax highlighting workers (default: up to 4, 1 per batch or serve worker)')
+    arg_parser.add_argument('--theme', default=DEFAULT_THEME, help='JSON file with the document styles')
+    arg_parser.add_argument('--highlighter', default='prism', choices=prism.HIGHLIGHTERS, help='Syntax highlighting backend')
+    arg_parser.add_argument('--image-dpi', type=int, default=DEFAULT_IMAGE_DPI, help='Downscale images to at most this resolution at the text width')
+    arg_parser.add_argument('--jpeg-quality', type=int, default=DEFAULT_JPEG_QUALITY, help='Quality of recompressed JPEG images (1-95)')
+    arg_parser.add_argument('--image-jobs', type=int, default=None, help='Number of parallel image processing threads (default: up to 4, 1 per batch or serve worker)')
+    arg_parser.add_argument('--reqres-limit', type=int, default=None, metavar='CHARS', help='Cut request/response messages longer than this, with a marker')
+    arg_parser.add_argument('--reqres-elide', action='store_true', help='Leave out the middle of long messages instead, keeping the start and end')
+    arg_parser.add_argument('--reqres-appendix', action='store_true', help='Add the shortened messages in full to an appendix')
+    arg_parser.add_argument('--compression', type=int, default=DEFAULT_COMPRESSION, choices=range(10), metavar='0-9', help='Deflate level of the output, 0 to store it uncompressed (images are always stored as they are)')
+    arg_parser.add_argument('--cache-dir', default=prism.cache.DEFAULT_CACHE_DIR, help='Directory for cached build artifacts')
+    arg_parser.add_argument('--cache-size', type=int, default=256, help='Maximum size of each cache (highlighted code, images) in MB')
+    arg_parser.add_argument('--no-cache', action='store_true', help='Do not read or write the caches')
+    arg_parser.add_argument('--profile', action='store_true', help='Print the time spent in each stage, counts and peak memory use')
+    arg_parser.add_argument('--profile-json', metavar='FILE', help='Write the profile as JSON to FILE')
+    arg_parser.add_argument('--profile-render', metavar='FILE', help='Write cProfile stats of the render stage to FILE (for pstats)')
+    args = arg_parser.parse_args(argv)
+    if args.batch is None and args.serve is None and args.output is None:
+        arg_parser.error('an output file, --batch or --serve is required')
+    if args.serve and (args.batch or args.watch or args.stream):
+        arg_parser.error('--serve does not work with --batch, --watch or --stream')
+    if args.serve and ':' not in args.serve and not is_stale_socket(args.serve):
+        arg_parser.error('--serve %s exists and is not a socket' % args.serve)
+    if args.batch and args.watch:
+        arg_parser.error('--watch does not work with --batch')
+    if args.watch and args.output == '-':
+        arg_parser.error('--watch needs an output file')
+    if (args.reqres_elide or args.reqres_appendix) and args.reqres_limit is None:
+        arg_parser.error('--reqres-elide and --reqres-appendix need --reqres-limit')
+    if args.stream and (args.batch or args.watch):
+        arg_parser.error('--stream does not work with --batch or --watch')
+    profiling = args.profile or args.profile_json or args.profile_render
+    if profiling and (args.batch or args.watch or args.serve):
+        arg_parser.error('--profile options profile a single build, not --batch, --watch or --serve')
+
+    # Batch and serve workers already run in parallel, so they do not split up further
+    pooled = bool(args.batch or args.serve)
+    jobs = 1 if pooled else DEFAULT_JOBS
+    options = dict(renderer=args.renderer, theme=args.theme, highlighter=args.highlighter,
+        highlight_jobs=args.highlight_jobs or jobs,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_size=args.cache_size * 1024 * 1024, image_dpi=args.image_dpi,
+        jpeg_quality=args.jpeg_quality, image_jobs=args.image_jobs or jobs,
+        jobs=1 if pooled else args.jobs, compression=args.compression,
+        body_limit=None if args.reqres_limit is None else
+            BodyLimit(args.reqres_limit, args.reqres_elide, args.reqres_appendix))
+
+    if args.batch:
+        # Jobs run from the manifest's directory, while paths given on the
+        # command line are relative to this one
+        directory = os.path.dirname(os.path.abspath(args.batch))
+        options['theme'] = os.path.abspath(options['theme'])
+        if options['cache_dir'] is not None:
+            options['cache_dir'] = os.path.abspath(options['cache_dir'])
+        if run_batch(load_manifest(args.batch), options, args.batch_jobs, directory):
+            sys.exit(1)
+        return
+
+    if args.serve:
+        service = ConversionService(options, args.serve_jobs, args.queue_size, args.timeout)
+        try:
+            service.warm()
+            # Stop on SIGTERM as on Ctrl-C
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            serve(service, args.serve)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+        return
+
+    with Converter(**options) as converter:
+        if args.watch:
+            try:
+                watch(converter, [args.files], args.output)
+            except KeyboardInterrupt:
+                pass
+            return
+        # With the Docx on stdout, everything else goes to stderr
+        output, log = args.output, sys.stdout
+        if output == '-':
+            output, log = sys.stdout.buffer, sys.stderr
+        profile = converter.profile
+        if args.profile_render:
+            profile.profiler = cProfile.Profile()
+        paths = find_sources([args.files])
+        if args.stream:
+            document = None
+            converter.stream(iter_sources(paths), output)
+        else:
+            with profile.stage('read'):
+                sources = read_sources(paths)
+            document = converter.convert(sources, output)
+        for report in converter.reports():
+            print(report, file=log)
+        if converter.fragment_cache is not None and not args.stream:
+            print('Rebuilt %d of %d files' % (len(converter.rebuilt), len(paths)), file=log)
+            for i in converter.rebuilt:
+                print('  %s' % paths[i], file=log)
+
+    # After closing the converter, so the peak RSS covers its worker processes
+    if profiling:
+        if document is not None:
+            profile.count_document(document)
+        if args.profile:
+            print(profile.format(), file=log)
+        if args.profile_json:
+            with open(args.profile_json, 'w') as f:
+                json.dump(profile.report(), f, indent=2)
+        if args.profile_render:
+            profile.profiler.dump_stats(args.profile_render)
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,255 @@
 import subprocess
-import base64
+import threading
+import atexit
+import html
+import warnings
+import queue
 import os
-import css_inline
+from concurrent.futures import ThreadPoolExecutor
+from .cache import HighlightCache
+from .pure import PygmentsHighlighter
+from . import theme
 
 file_path = os.path.dirname(__file__)
 
 languages = ["markup", "css", "clike", "javascript", "abap", "abnf", "actionscript", "ada", "apacheconf", "apl", "applescript", "arduino", "arff", "asciidoc", "asm6502", "aspnet", "autohotkey", "autoit", "bash", "basic", "batch", "bison", "bnf", "brainfuck", "bro", "c", "csharp", "cpp", "cil", "coffeescript", "cmake", "clojure", "crystal", "csp", "css-extras", "d", "dart", "diff", "django", "docker", "ebnf", "eiffel", "ejs", "elixir", "elm", "erb", "erlang", "fsharp", "flow", "fortran", "gcode", "gedcom", "gherkin", "git", "glsl", "gml", "go", "graphql", "groovy", "haml", "handlebars", "haskell", "haxe", "hcl", "http", "hpkp", "hsts", "ichigojam", "icon", "inform7", "ini", "io", "j", "java", "javadoc", "javadoclike", "javastacktrace", "jolie", "jsdoc", "js-extras", "json", "jsonp", "json5", "julia", "keyman", "kotlin", "latex", "less", "liquid", "lisp", "livescript", "lolcode", "lua", "makefile", "markdown", "markup-templating", "matlab", "mel", "mizar", "monkey", "n1ql", "n4js", "nand2tetris-hdl", "nasm", "nginx", "nim", "nix", "nsis", "objectivec", "ocaml", "opencl", "oz", "parigp", "parser", "pascal", "perl", "php", "phpdoc", "php-extras", "plsql", "powershell", "processing", "prolog", "properties", "protobuf", "pug", "puppet", "pure", "python", "q", "qore", "r", "jsx", "tsx", "renpy", "reason", "regex", "rest", "rip", "roboconf", "ruby", "rust", "sas", "sass", "scss", "scala", "scheme", "smalltalk", "smarty", "sql", "soy", "stylus", "swift", "tap", "tcl", "textile", "toml", "tt2", "twig", "typescript", "t4-cs", "t4-vb", "t4-templating", "vala", "vbnet", "velocity", "verilog", "vhdl", "vim", "visual-basic", "wasm", "wiki", "xeora", "xojo", "xquery", "yaml", ]
 
-def highlight(code, language):
-    code_b64 = base64.b64encode(code.encode()).decode('utf-8')
-    
-    node_command = ['node', os.path.join(file_path,'highlight.js'), code_b64, language]
+CHUNK_SIZE = 64 * 1024
+# Code blocks larger than this are not highlighted at all
+MAX_HIGHLIGHT_SIZE = 8 * 1024 * 1024
 
-    result = subprocess.run(node_command, capture_output=True, text=True)
+class PrismWorker:
+    """
+    Long-lived Node process running highlight.js, so prism.js is only
+    loaded once per worker instead of once per code block.
 
-    output = result.stdout.strip()
-    if (result.stderr.strip() != ''):
-        raise Exception(result.stderr.strip())
+    Requests and responses are length-prefixed frames over stdin/stdout:
+    a "<id> <language> <length>" header line followed by <length> bytes of
+    UTF-8 code, answered by an "<id> <ok|error> <length>" line and the HTML
+    or error message. Payloads are streamed in CHUNK_SIZE pieces, so code
+    size is not bounded by ARG_MAX and nothing is base64 encoded.
+    """
+    def __init__(self):
+        self.process = None
+        self.next_id = 0
+        self.lock = threading.Lock()
 
-    code = base64.b64decode(output).decode('utf-8')
-    css = open(os.path.join(file_path, 'prism.css')).read()
-    inline = css_inline.inline(f'<style>{css}</style>'+code)
-    code = inline[inline.find('<body>')+len('<body>'):][:-len('</body></html>')]
-    return code
+    def start(self):
+        node_command = ['node', os.path.join(file_path, 'highlight.js')]
+        self.process = subprocess.Popen(node_command,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
 
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.process.stdout.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise BrokenPipeError('Prism worker exited')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def request(self, code, language):
+        self.next_id += 1
+        payload = memoryview(code.encode('utf-8'))
+        stdin = self.process.stdin
+        stdin.write(b'%d %s %d\n' % (self.next_id, language.encode(), len(payload)))
+        for i in range(0, len(payload), CHUNK_SIZE):
+            stdin.write(payload[i:i+CHUNK_SIZE])
+        stdin.flush()
+
+        header = self.process.stdout.readline()
+        if not header.endswith(b'\n'):
+            raise BrokenPipeError('Prism worker exited')
+        request_id, status, length = header.split()
+        if int(request_id) != self.next_id:
+            raise Exception('Prism worker answered out of order')
+        return status.decode(), self.read(int(length)).decode('utf-8')
+
+    def highlight(self, code, language):
+        with self.lock:
+            # Restart the worker once if it has died in the meantime
+            for attempt in range(2):
+                if not self.alive():
+                    self.start()
+                try:
+                    status, body = self.request(code, language)
+                    break
+                except (BrokenPipeError, OSError):
+                    self.close()
+                    if attempt == 1:
+                        raise
+        if status == 'error':
+            raise Exception(body)
+        return body
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+
+class PrismHighlighter:
+    """
+    Prism running in a pool of Node workers. This is the reference
+    backend: other backends emit the same token spans it does.
+    """
+    name = 'prism'
+    # Blocks handed to the backend, for profiling
+    calls = 0
+
+    def __init__(self):
+        self.workers = [PrismWorker()]
+        self.version = prism_version()
+
+    def highlight(self, code, language):
+        return self.workers[0].highlight(code, language)
+
+    def highlight_many(self, blocks, jobs=1):
+        jobs = max(1, min(jobs, len(blocks)))
+        while len(self.workers) < jobs:
+            self.workers.append(PrismWorker())
+
+        idle = queue.Queue()
+        for w in self.workers[:jobs]:
+            idle.put(w)
+
+        def run(block):
+            w = idle.get()
+            try:
+                return w.highlight(*block)
+            except OSError:
+                # The worker died twice on this block
+                return None
+            finally:
+                idle.put(w)
+
+        if jobs == 1:
+            return {block: run(block) for block in blocks}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return dict(zip(blocks, executor.map(run, blocks)))
+
+    def close(self):
+        for w in self.workers:
+            w.close()
+
+
+HIGHLIGHTERS = {
+    'prism': PrismHighlighter,
+    'pygments': PygmentsHighlighter,
+}
+
+_highlighters = {}
+# Number of acquire() calls not released yet, per highlighter name
+_users = {}
+_lock = threading.Lock()
+
+def _forget():
+    # Workers belong to the process that started them, a forked child starts its own
+    _highlighters.clear()
+    _users.clear()
+
+os.register_at_fork(after_in_child=_forget)
+_theme = theme.load()
+
+def prism_version():
+    # prism.js starts with a "/* PrismJS 1.29.0" banner
+    with open(os.path.join(file_path, 'prism.js'), encoding='utf-8') as f:
+        return f.readline().strip()
+
+def get_highlighter(name='prism'):
+    with _lock:
+        if name not in _highlighters:
+            _highlighters[name] = HIGHLIGHTERS[name]()
+        return _highlighters[name]
+
+def acquire(name='prism'):
+    """
+    The named highlighter, for a user that keeps it warm until it calls
+    release(). Users share it, and its workers are only closed once the
+    last of them has released it.
+    """
+    h = get_highlighter(name)
+    with _lock:
+        _users[name] = _users.get(name, 0) + 1
+    return h
+
+def release(name='prism'):
+    with _lock:
+        _users[name] -= 1
+        if _users[name] > 0:
+            return
+        del _users[name]
+        h = _highlighters.pop(name, None)
+    if h is not None:
+        h.close()
+
+def inline_style(code):
+    return _theme.inline(code)
+
+def highlight(code, language, highlighter='prism'):
+    return inline_style(get_highlighter(highlighter).highlight(code, language))
+
+def highlight_many(blocks, jobs=1, cache=None, highlighter='prism', max_size=MAX_HIGHLIGHT_SIZE):
+    """
+    Highlight an iterable of (code, language) pairs with the named backend,
+    spread over up to `jobs` workers where the backend supports it.
+    Duplicate pairs are only highlighted once, and pairs found in `cache`
+    (a HighlightCache) are not highlighted at all; trimming it is left to
+    the caller. Blocks longer than
+    `max_size` characters, or that crash the backend, are returned as
+    plain escaped text with a warning.
+    Returns a dict mapping each (code, language) pair to its HTML.
+    """
+    h = get_highlighter(highlighter)
+    blocks = list(dict.fromkeys(blocks))
+    results = {}
+    if cache is not None:
+        for block in blocks:
+            cached = cache.get(*block, h.version)
+            if cached is not None:
+                results[block] = cached
+        blocks = [block for block in blocks if block not in results]
+    if len(blocks) == 0:
+        return results
+
+    plain = [block for block in blocks if len(block[0]) > max_size]
+    for block in plain:
+        warnings.warn('Not highlighting a %d character %s code block (limit is %d)'
+            % (len(block[0]), block[1], max_size))
+        results[block] = html.escape(block[0], quote=False)
+    blocks = [block for block in blocks if len(block[0]) <= max_size]
+
+    h.calls += len(blocks)
+    highlighted = h.highlight_many(blocks, jobs)
+    for block in blocks:
+        if highlighted[block] is None:
+            warnings.warn('Highlighter failed on a %s code block, leaving it plain' % block[1])
+            results[block] = html.escape(block[0], quote=False)
+            continue
+        results[block] = inline_style(highlighted[block])
+        if cache is not None:
+            cache.put(*block, h.version, results[block])
+    return results
+
+def close():
+    # Closes every highlighter, whoever acquired it
+    with _lock:
+        highlighters = list(_highlighters.values())
+        _highlighters.clear()
+        _users.clear()
+    for h in highlighters:
+        h.close()
+
+atexit.register(close)
 
-if __name__ == '__main__':
-    code = "const message = 'Hello, World!';"
-    code_hl = (highlight(code, 'javascript'))
-    print(code_hl)
@@ -0,0 +1,6 @@
+from prism import HIGHLIGHTERS, highlight, close
+
+code = "const message = 'Hello, World!';"
+for name in HIGHLIGHTERS:
+    print(highlight(code, 'javascript', name))
+close()
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+file_path = os.path.dirname(__file__)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'md2docx')
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class FileCache:
+    """
+    Content-addressed store with one file per entry, kept in its own
+    `name` subdirectory of the cache directory. The least recently used
+    entries are evicted once that subdirectory grows past `max_size` bytes.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, name='files', max_size=DEFAULT_MAX_SIZE, suffix=''):
+        self.name = name
+        self.directory = os.path.join(directory, name)
+        self.max_size = max_size
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        # Misses as of the last trim()
+        self.trimmed = 0
+        # Image and highlight threads count hits and misses concurrently
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:] + self.suffix)
+
+    def read(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Bump the access time used for LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            # Another process may have trimmed it since
+            self.count(misses=1)
+            return None
+        self.count(hits=1)
+        return data
+
+    def count(self, hits=0, misses=0):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so concurrent runs never read half an entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def trim(self):
+        # Every miss is followed by a write, and only writes grow the cache
+        if self.misses == self.trimmed:
+            return
+        self.trimmed = self.misses
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def report(self):
+        return '%s cache: %d hits, %d misses' % (self.name.capitalize(), self.hits, self.misses)
+
+class HighlightCache(FileCache):
+    """
+    Highlighted code HTML, keyed by the code, its language, the
+    highlighter version and the theme.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        super().__init__(directory, 'highlight', max_size, '.html')
+        self.salt = file_digest(os.path.join(file_path, 'prism.css')) + '\0'
+
+    def key(self, code, language, version):
+        h = hashlib.sha256()
+        h.update(self.salt.encode())
+        h.update(version.encode() + b'\0')
+        h.update(language.encode() + b'\0')
+        h.update(code.encode())
+        return h.hexdigest()
+
+    def get(self, code, language, version):
+        data = self.read(self.key(code, language, version))
+        return None if data is None else data.decode('utf-8')
+
+    def put(self, code, language, version, html):
+        self.write(self.key(code, language, version), html.encode('utf-8'))
@@ -1,13 +1,61 @@
 const path = require('path');
 const file_path = path.dirname(__filename);
 
-const fs = require('fs');
-
 const Prism = require(path.join(file_path, 'prism.js'));
 
-const code = Buffer.from(process.argv[2], 'base64').toString('utf-8');
-const language = process.argv[3];
+// Length-prefixed frames on stdin/stdout:
+//   > "<id> <language> <length>\n" followed by <length> bytes of UTF-8 code
+//   < "<id> ok <length>\n" followed by the highlighted HTML
+//   < "<id> error <length>\n" followed by the error message
+// Input is buffered as a list of chunks and only joined once a whole
+// request has arrived, so large code blocks are never copied repeatedly.
+let chunks = [];
+let buffered = 0;
+let header = null;
+
+function take(size) {
+    const data = Buffer.concat(chunks, buffered);
+    chunks = [data.subarray(size)];
+    buffered -= size;
+    return data.subarray(0, size);
+}
+
+function respond(id, status, body) {
+    const payload = Buffer.from(body, 'utf-8');
+    process.stdout.write(id + ' ' + status + ' ' + payload.length + '\n');
+    process.stdout.write(payload);
+}
+
+function handle(id, language, code) {
+    try {
+        const grammar = Prism.languages[language];
+        if (grammar === undefined) {
+            throw new Error('Unknown language: ' + language);
+        }
+        respond(id, 'ok', Prism.highlight(code, grammar, language));
+    } catch (e) {
+        respond(id, 'error', String(e));
+    }
+}
 
-const highlightedCode = Prism.highlight(code, Prism.languages[language], language);
+function pump() {
+    while (true) {
+        if (header === null) {
+            const newline = chunks.length === 0 ? -1 : Buffer.concat(chunks, buffered).indexOf(10);
+            if (newline < 0) return;
+            const [id, language, length] = take(newline + 1).toString('utf-8').trim().split(' ');
+            header = { id: id, language: language, length: parseInt(length) };
+        }
+        if (buffered < header.length) return;
+        const code = take(header.length).toString('utf-8');
+        const { id, language } = header;
+        header = null;
+        handle(id, language, code);
+    }
+}
 
-console.log(Buffer.from(highlightedCode, 'utf-8').toString('base64'));
+process.stdin.on('data', (chunk) => {
+    chunks.push(chunk);
+    buffered += chunk.length;
+    pump();
+});
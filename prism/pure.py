@@ -0,0 +1,109 @@
+import html
+
+# Prism language names that Pygments knows under another name
+LANGUAGE_ALIASES = {
+    'markup': 'html',
+    'clike': 'c',
+    'css-extras': 'css',
+    'js-extras': 'javascript',
+    'php-extras': 'php',
+    'markup-templating': 'html+django',
+    'visual-basic': 'vbnet',
+    'plsql': 'plpgsql',
+    'bro': 'zeek',
+}
+
+def token_classes():
+    # Pygments token type -> Prism token class. Types that are not listed
+    # inherit the class of their closest listed parent.
+    from pygments import token as t
+    return {
+        t.Keyword: 'keyword',
+        t.Keyword.Constant: 'boolean',
+        t.Keyword.Type: 'class-name',
+        t.Name.Builtin: 'builtin',
+        t.Name.Builtin.Pseudo: 'keyword',
+        t.Name.Function: 'function',
+        t.Name.Class: 'class-name',
+        t.Name.Exception: 'class-name',
+        t.Name.Decorator: 'decorator annotation punctuation',
+        t.Name.Tag: 'tag',
+        t.Name.Attribute: 'attr-name',
+        t.Name.Variable: 'variable',
+        t.Name.Constant: 'constant',
+        t.Name.Entity: 'entity',
+        t.Name.Property: 'property',
+        t.Name.Label: 'symbol',
+        t.String: 'string',
+        t.String.Regex: 'regex',
+        t.String.Symbol: 'symbol',
+        t.Number: 'number',
+        t.Operator: 'operator',
+        t.Operator.Word: 'keyword',
+        t.Punctuation: 'punctuation',
+        t.Comment: 'comment',
+        t.Comment.Preproc: 'macro property',
+        t.Generic.Deleted: 'deleted',
+        t.Generic.Inserted: 'inserted',
+        t.Generic.Heading: 'important',
+        t.Generic.Subheading: 'important',
+        t.Generic.Strong: 'bold',
+        t.Generic.Emph: 'italic',
+        t.Generic.Prompt: 'punctuation',
+    }
+
+class PygmentsHighlighter:
+    """
+    In-process backend built on Pygments. It emits the same
+    <span class="token ..."> markup as Prism, so the Prism theme and the
+    rest of the pipeline apply unchanged, but needs no Node runtime.
+    """
+    name = 'pygments'
+    # Blocks handed to the backend, for profiling
+    calls = 0
+
+    def __init__(self):
+        try:
+            import pygments
+        except ImportError:
+            raise Exception('The pygments highlighter requires Pygments (pip install pygments)')
+        self.version = 'pygments %s' % pygments.__version__
+        self.classes = token_classes()
+        self.lexers = {}
+
+    def lexer(self, language):
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+        if language not in self.lexers:
+            try:
+                lexer = get_lexer_by_name(LANGUAGE_ALIASES.get(language, language),
+                    stripnl=False, ensurenl=False)
+            except ClassNotFound:
+                raise Exception('Unknown language: ' + language)
+            self.lexers[language] = lexer
+        return self.lexers[language]
+
+    def token_class(self, ttype):
+        while ttype is not None:
+            if ttype in self.classes:
+                return self.classes[ttype]
+            ttype = ttype.parent
+        return None
+
+    def highlight(self, code, language):
+        out = []
+        for ttype, value in self.lexer(language).get_tokens(code):
+            value = html.escape(value, quote=False)
+            cls = self.token_class(ttype)
+            if cls is None:
+                out.append(value)
+            else:
+                out.append('<span class="token %s">%s</span>' % (cls, value))
+        return ''.join(out)
+
+    def highlight_many(self, blocks, jobs=1):
+        # Lexing holds the GIL, so there is nothing to gain from threads
+        return {block: self.highlight(*block) for block in blocks}
+
+    def close(self):
+        pass
@@ -0,0 +1,79 @@
+import os
+import re
+
+file_path = os.path.dirname(__file__)
+
+# Selectors made only of classes, e.g. ".token.class-name"
+CLASS_SELECTOR = re.compile(r'^(?:\.[\w-]+)+$')
+COMMENT = re.compile(r'/\*.*?\*/', re.S)
+SPAN = re.compile(r'<span class="([^"]*)"')
+
+def parse_rules(css):
+    """
+    Yield (selector, declarations) for every top-level rule in `css`.
+    At-rule blocks such as @media are skipped along with their contents.
+    """
+    css = COMMENT.sub('', css)
+    i = 0
+    while True:
+        start = css.find('{', i)
+        if start < 0:
+            return
+        prelude = css[i:start].strip()
+        depth, end = 1, start + 1
+        while depth > 0 and end < len(css):
+            if css[end] == '{': depth += 1
+            elif css[end] == '}': depth -= 1
+            end += 1
+        body = css[start+1:end-1]
+        i = end
+        if prelude.startswith('@'):
+            continue
+        declarations = []
+        for d in body.split(';'):
+            if ':' not in d: continue
+            k, v = d.split(':', 1)
+            declarations.append((k.strip(), v.strip()))
+        for selector in prelude.split(','):
+            yield selector.strip(), declarations
+
+class Theme:
+    """
+    Prism theme compiled into a token class -> inline style table.
+    Highlighted code only ever consists of bare token spans, so only
+    rules whose selectors are plain class lists can match it.
+    """
+    def __init__(self, css):
+        self.rules = []
+        for order, (selector, declarations) in enumerate(parse_rules(css)):
+            if not CLASS_SELECTOR.match(selector):
+                continue
+            classes = frozenset(selector[1:].split('.'))
+            self.rules.append((len(classes), order, classes, declarations))
+        # Apply by specificity, then source order, like the cascade would
+        self.rules.sort(key=lambda r: r[:2])
+        self.styles = {}
+
+    def style(self, class_attr):
+        if class_attr in self.styles:
+            return self.styles[class_attr]
+        classes = set(class_attr.split())
+        style = {}
+        for _, _, selector, declarations in self.rules:
+            if selector <= classes:
+                style.update(declarations)
+        style = ''.join('%s: %s;' % (k, v) for k, v in style.items())
+        self.styles[class_attr] = style
+        return style
+
+    def inline(self, html):
+        def styled(match):
+            style = self.style(match.group(1))
+            if style == '':
+                return match.group(0)
+            return '%s style="%s"' % (match.group(0), style)
+        return SPAN.sub(styled, html)
+
+def load(path=os.path.join(file_path, 'prism.css')):
+    with open(path, encoding='utf-8') as f:
+        return Theme(f.read())
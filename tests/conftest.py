@@ -0,0 +1,5 @@
+import os
+import sys
+
+# md2docx.py is a script at the top of the repository, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -0,0 +1,36 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from prism.cache import FileCache
+
+def test_counts_concurrent_reads(tmp_path):
+    cache = FileCache(str(tmp_path), 'test')
+    cache.write('aa00', b'data')
+    keys = ['aa00', 'bb00'] * 2000
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(cache.read, keys))
+    assert (cache.hits, cache.misses) == (2000, 2000)
+
+def test_trims_only_after_misses(tmp_path):
+    cache = FileCache(str(tmp_path), 'test', max_size=10)
+    for key in ('aa00', 'bb00'):
+        cache.write(key, b'0123456789')
+    cache.read('aa00')
+    cache.trim()
+    assert cache.read('bb00') is not None
+    assert cache.read('cc00') is None
+    cache.write('cc00', b'0123456789')
+    cache.trim()
+    assert sum(len(files) for _, _, files in os.walk(cache.directory)) == 1
+
+def test_entry_trimmed_while_read_is_a_miss(tmp_path, monkeypatch):
+    cache = FileCache(str(tmp_path), 'test')
+    cache.write('aa00', b'data')
+
+    def utime(path):
+        # Another process trims the entry between open() and utime()
+        os.remove(path)
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(os, 'utime', utime)
+    assert cache.read('aa00') is None
+    assert (cache.hits, cache.misses) == (0, 1)
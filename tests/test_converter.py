@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import md2docx
+import prism
+
+def test_close_keeps_highlighter_of_other_converters():
+    first = md2docx.Converter(cache_dir=None)
+    second = md2docx.Converter(cache_dir=None)
+    first.warm()
+    h = prism.get_highlighter('prism')
+    worker = h.workers[0]
+    assert worker.alive()
+    first.close()
+    first.close()
+    assert prism.get_highlighter('prism') is h and worker.alive()
+    second.close()
+    assert not worker.alive()
+
+SOURCES = ['## Summary\n', '| k | v |\n|---|---|\n| a | b |\n', '```python\nx = 1\n```\n',
+    'Caption after code\n', '', '| x | y |\n|---|---|\n| 1 | 2 |\n']
+
+def body_xml(doc):
+    return doc.element.body.xml
+
+@pytest.mark.parametrize('renderer', ['markdown', 'html'])
+def test_fragments_render_like_one_document(tmp_path, renderer):
+    with md2docx.Converter(renderer, cache_dir=None, highlighter='pygments') as converter:
+        expected = body_xml(converter.render(SOURCES))
+    assert 'w:fill="057d9f"' in expected
+    with md2docx.Converter(renderer, cache_dir=str(tmp_path), highlighter='pygments') as converter:
+        assert body_xml(converter.render(SOURCES)) == expected
+        # From the cache, and with the file before the table changed
+        assert body_xml(converter.render(SOURCES)) == expected
+        assert converter.rebuilt == []
+        changed = ['## Not a summary\n\nText\n'] + SOURCES[1:]
+        rebuilt = body_xml(converter.render(changed))
+        assert converter.rebuilt == [0, 1]
+    with md2docx.Converter(renderer, cache_dir=None, highlighter='pygments') as converter:
+        assert rebuilt == body_xml(converter.render(changed))
+
+def test_cached_fragment_round_trip(tmp_path):
+    (tmp_path / 'a.png').write_bytes(open(os.path.join(os.path.dirname(md2docx.__file__), 'puppy.jpeg'), 'rb').read())
+    markdown = '# [Link](https://example.com)\n\n![](%s)\n\n1. one\n2. two\n' % (tmp_path / 'a.png')
+    with md2docx.Converter(cache_dir=str(tmp_path / 'cache'), highlighter='pygments') as converter:
+        fragment = converter.fragment(markdown)
+        fragment.last = 'ol'
+        loaded = md2docx.Fragment.loads(fragment.dumps())
+        assert vars(loaded) == vars(fragment)
+
+@pytest.mark.parametrize('data', [b'', b'\x80', b'[]', b'{"body": ""}', b'\x80\x04\x95'])
+def test_damaged_fragment_is_a_miss(tmp_path, data):
+    with md2docx.Converter(cache_dir=str(tmp_path), highlighter='pygments') as converter:
+        key = converter.fragment_key('Text\n', None)
+        converter.fragment_cache.write(key, data)
+        assert converter.cached_fragment(key) is None
+        assert converter.fragment_cache.misses == 1
+
+REQRES = ('```reqres\n--- Request\nGET / HTTP/1.1\n--- Response\nHTTP/1.1 200 OK\n'
+    '--- Request\nGET /next HTTP/1.1\n--- Response\nHTTP/1.1 204 No Content\n```\n')
+
+@pytest.mark.parametrize('before', ['', '## Summary\n\n', 'Text\n\n'])
+def test_reqres_styled_like_html_renderer(before):
+    tables = []
+    for renderer in ('markdown', 'html'):
+        with md2docx.Converter(renderer, cache_dir=None, highlighter='pygments') as converter:
+            table = converter.render(before + REQRES).tables[0]
+        tables.append([cell._tc.tcPr.xml for row in table.rows for cell in row.cells])
+    assert tables[0] == tables[1]
@@ -0,0 +1,53 @@
+import os
+import zipfile
+
+import docx
+import pytest
+
+import md2docx
+
+def large_markdown():
+    # Makes word/document.xml well over 1 MB, so it is deflated in pieces
+    return '\n\n'.join('Paragraph %d of a long report. ' % i * 20 for i in range(3000))
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_large_part_round_trips(tmp_path, jobs):
+    output = tmp_path / 'report.docx'
+    md2docx.convert(large_markdown(), str(output), highlighter='pygments', cache_dir=None, image_jobs=jobs)
+    with zipfile.ZipFile(output) as z:
+        assert z.getinfo('word/document.xml').file_size > 1 << 20
+        assert z.testzip() is None
+    paragraphs = docx.Document(str(output)).paragraphs
+    assert any(p.text.startswith('Paragraph 2999 of a long report.') for p in paragraphs)
+
+def test_failed_save_keeps_previous_output(tmp_path, monkeypatch):
+    output = tmp_path / 'report.docx'
+    output.write_bytes(b'previous')
+    os.chmod(output, 0o640)
+    doc = docx.Document()
+    doc.add_paragraph('x' * 100000)
+    monkeypatch.setattr(md2docx, 'ZIP_LIMIT', 50000)
+    with pytest.raises(ValueError):
+        md2docx.save_document(doc, str(output), compression=0)
+    assert output.read_bytes() == b'previous'
+    assert os.listdir(tmp_path) == ['report.docx']
+    monkeypatch.undo()
+    md2docx.save_document(doc, str(output))
+    assert zipfile.ZipFile(output).testzip() is None
+    assert os.stat(output).st_mode & 0o777 == 0o640
+
+def test_failed_stream_keeps_previous_output(tmp_path):
+    output = tmp_path / 'report.docx'
+    output.write_bytes(b'previous')
+
+    def sources():
+        yield '# Finding\n\nText\n'
+        raise RuntimeError('unreadable finding')
+    with md2docx.Converter(highlighter='pygments', cache_dir=None) as converter:
+        with pytest.raises(RuntimeError):
+            converter.stream(sources(), str(output))
+        assert output.read_bytes() == b'previous'
+        assert os.listdir(tmp_path) == ['report.docx']
+        converter.stream(iter(['# Finding\n\nText\n']), str(output))
+    assert zipfile.ZipFile(output).testzip() is None
+    assert docx.Document(str(output)).paragraphs[0].text == 'Finding'
@@ -0,0 +1,101 @@
+import json
+
+import pytest
+import soupsieve
+from bs4 import BeautifulSoup as bs
+
+import md2docx
+
+HTML = '''
+<h1>Title</h1>
+<p>Intro with <code>code</code> and <a href="#">a link</a></p>
+<p><img src="a.png"> Caption with <code>code</code></p>
+<h2>Summary</h2>
+<table>
+<thead><tr><th>Key</th><th>Value</th></tr></thead>
+<tbody>
+<tr><td>1</td><td>a</td></tr><tr><td>2</td><td>b</td></tr>
+<tr><td>3</td><td>c</td></tr><tr><td>4</td><td>d</td></tr>
+<tr><td>5</td><td>e</td></tr>
+</tbody>
+</table>
+<p>After the table</p>
+<pre><code class="language-python">x = 1</code></pre>
+<p>After the code with <code>code</code></p>
+<h2>Summary without a header</h2>
+<table>
+<tbody><tr><td>Key</td><td>Value</td></tr><tr><td>Key</td><td>Value</td></tr></tbody>
+</table>
+<h3>Details</h3>
+<table class="reqres">
+<thead><tr><th><b>Reproduction example</b></th><th></th></tr></thead>
+<tbody>
+<tr><td><b>Request</b><i>blurb</i></td><td><pre><code class="language-http">GET /</code></pre></td></tr>
+<tr><td><b>Response</b></td><td><pre><code>200</code><code class="omitted">...</code></pre></td></tr>
+</tbody>
+</table>
+<ul><li><p>One</p><ul><li>Nested</li></ul></li><li>Two</li></ul>
+'''
+
+SELECTORS = [
+    'p', 'p, th, td, li', '*', 'pre > code', 'tr > *', 'table + p', 'pre + p code',
+    'h2 ~ table', 'h2 ~ p', 'ul li', 'ul > li > ul > li',
+    'p:has(img)', 'p:has(img) code', 'li:has(> ul)', 'li:has(> p)',
+    'tr:first-child', 'td:last-child', 'tr:nth-child(even)', 'tbody > tr:nth-child(odd)',
+    'tr:nth-child(3)', 'tbody > tr:nth-child(2n+1)', 'tbody > tr:nth-child(-n+2)', 'tr:nth-child(3n)',
+    '*:not(h2) + table > thead th', 'h2 + table > :first-child > tr:first-child > td',
+    '.reqres > tbody > tr > td:nth-child(2)', '.reqres code.omitted', 'code.language-python',
+    'td:not(:first-child)', 'table:not(.reqres) td',
+]
+
+@pytest.fixture(scope='module')
+def soup():
+    return bs(HTML, 'html.parser')
+
+@pytest.mark.parametrize('selector', SELECTORS)
+def test_matches_like_soupsieve(soup, selector):
+    match = md2docx.Selector(selector).match
+    siblings = md2docx.Siblings()
+    tags = soup.find_all(True)
+    expected = [t for t in tags if soupsieve.match(selector, t)]
+    assert expected, 'selector matches nothing in the test document'
+    assert [t for t in tags if match(t, siblings)] == expected
+
+@pytest.mark.parametrize('arg, positions', [
+    ('odd', [1, 3, 5]), ('even', [2, 4]), ('2n+1', [1, 3, 5]), ('2n-1', [1, 3, 5]),
+    ('3n', [3]), ('n+4', [4, 5]), ('-n+2', [1, 2]), ('+3', [3]), ('0n+2', [2]), ('- n + 3', [1, 2, 3]),
+])
+def test_nth_child(arg, positions):
+    soup = bs('<ul>%s</ul>' % ''.join('<li>%d</li>' % i for i in range(1, 6)), 'html.parser')
+    match = md2docx.Selector('li:nth-child(%s)' % arg).match
+    siblings = md2docx.Siblings()
+    assert [int(t.text) for t in soup.find_all('li') if match(t, siblings)] == positions
+
+def test_nth_child_only_child():
+    # soupsieve 2.5 gets this one wrong: an only child is odd
+    soup = bs('<ul><li>1</li></ul>', 'html.parser')
+    for arg in ('odd', '2n+1', '-n+2', '1'):
+        assert md2docx.Selector('li:nth-child(%s)' % arg).match(soup.li, md2docx.Siblings())
+
+def test_default_theme_compiles():
+    # Every rule of the shipped theme goes through Selector, not the fallback
+    with open(md2docx.DEFAULT_THEME, encoding='utf-8') as f:
+        rules = json.load(f)['rules']
+    for selector, _, _ in rules:
+        md2docx.Selector(selector)
+
+@pytest.mark.parametrize('selector', ['a[href]', 'p::first-line', '> p', 'p >', 'p:nth-child(foo)'])
+def test_unsupported(selector):
+    with pytest.raises(ValueError):
+        md2docx.Selector(selector)
+
+@pytest.mark.parametrize('selector', ['a[href]', 'td:nth-last-child(1)'])
+def test_fallback_to_soupsieve(tmp_path, selector):
+    path = tmp_path / 'theme.json'
+    path.write_text(json.dumps({'styles': {'base': {}, 'hit': {'color': 'red'}},
+        'rules': [[selector, 'set', 'hit']]}))
+    soup = bs(HTML, 'html.parser')
+    md2docx.Theme(str(path)).apply(soup)
+    expected = soupsieve.select(selector, soup)
+    assert expected
+    assert [t for t in soup.find_all(True) if t.get('style') == {'color': 'red'}] == expected
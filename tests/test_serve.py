@@ -0,0 +1,107 @@
+import http.client
+import io
+import os
+import tempfile
+import threading
+import zipfile
+
+import PIL.Image
+import pytest
+
+import md2docx
+
+class Service:
+    """Stands in for ConversionService, answering with the sources."""
+    def submit(self, sources, directory):
+        return '\n'.join(sources).encode('utf-8')
+
+@pytest.fixture
+def server():
+    server = md2docx.ThreadingHTTPServer(('127.0.0.1', 0), md2docx.ServeHandler)
+    server.service = Service()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def post(server, path, body, headers):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+    connection.putrequest('POST', path)
+    for name, value in headers.items():
+        connection.putheader(name, value)
+    connection.endheaders(body)
+    response = connection.getresponse()
+    result = response.status, response.read()
+    connection.close()
+    return result
+
+def archive(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as z:
+        for name, text in files.items():
+            z.writestr(name, text)
+    return data.getvalue()
+
+def post_zip(server, query, files):
+    data = archive(files)
+    return post(server, '/convert?files=' + query, data,
+                {'Content-Type': 'application/zip', 'Content-Length': str(len(data))})
+
+def test_zip_files_are_converted_in_order(server):
+    status, body = post_zip(server, 'findings/*.md', {'findings/b.md': 'B', 'findings/a.md': 'A', 'c.md': 'C'})
+    assert status == 200 and body == b'A\nB'
+
+@pytest.mark.parametrize('pattern', ['/etc/host*', '../*', 'findings/../../*', '..\\*'])
+def test_files_outside_archive_are_refused(server, pattern):
+    status, body = post_zip(server, pattern, {'a.md': 'A'})
+    assert status == 400 and b'hosts' not in body
+
+@pytest.mark.parametrize('length', ['abc', '-1', '1e3'])
+def test_invalid_content_length(server, length):
+    status, body = post(server, '/convert', b'', {'Content-Length': length})
+    assert status == 400
+
+def test_serve_keeps_file_that_is_not_a_socket(tmp_path):
+    report = tmp_path / 'report.docx'
+    report.write_bytes(b'report')
+    with pytest.raises(SystemExit):
+        md2docx.main(['--serve', str(report)])
+    with pytest.raises(FileExistsError):
+        md2docx.serve(Service(), str(report))
+    assert report.read_bytes() == b'report'
+
+@pytest.fixture
+def converting_server():
+    service = md2docx.ConversionService(dict(highlighter='pygments', cache_dir=None, highlight_jobs=1,
+        image_jobs=1), workers=1)
+    server = md2docx.ThreadingHTTPServer(('127.0.0.1', 0), md2docx.ServeHandler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+def png():
+    data = io.BytesIO()
+    PIL.Image.new('RGB', (4, 4), 'red').save(data, 'PNG')
+    return data.getvalue()
+
+def test_images_outside_upload_are_refused(converting_server, tmp_path):
+    secret = tmp_path / 'secret.png'
+    secret.write_bytes(png())
+    relative = os.path.relpath(secret, tempfile.gettempdir())
+    body = ('![x](%s)\n' % secret).encode()
+    status, _ = post(converting_server, '/convert', body, {'Content-Length': str(len(body))})
+    assert status == 400
+    for src in (str(secret), '../' * 8 + str(secret).lstrip('/'), '../' + relative):
+        status, _ = post_zip(converting_server, '*.md', {'a.md': '![x](%s)\n' % src})
+        assert status == 400
+
+def test_images_in_upload_are_embedded(converting_server):
+    status, body = post_zip(converting_server, '*.md', {'a.md': '![x](img/a.png)\n', 'img/a.png': png()})
+    assert status == 200
+    with zipfile.ZipFile(io.BytesIO(body)) as z:
+        assert any(name.startswith('word/media/') for name in z.namelist())